@@ -1,7 +1,12 @@
 #!/usr/bin/python
 # coding: utf-8
 
-from sys import argv
+import platform
+import sys
+import sysconfig
+from argparse import ArgumentParser
+from threading import Thread
+from time import time
 from timeit import timeit
 
 import chevron
@@ -17,7 +22,7 @@ def make_test(template=None, data=None, expected=None):
     return test
 
 
-def main(times):
+def main(times, threads=None):
     args = {
         'template': """\
 {{# comments }}
@@ -73,11 +78,56 @@ def main(times):
 
     test = make_test(**args)
 
-    print(timeit(test, number=times))
+    if threads is None:
+        print(timeit(test, number=times))
+    else:
+        threaded(test, times, threads)
+
+
+def gil_status():
+    """Describe the interpreter, and whether the GIL is in the way"""
+    build = 'free-threaded' if sysconfig.get_config_var('Py_GIL_DISABLED') \
+        else 'with a GIL'
+    if hasattr(sys, '_is_gil_enabled'):
+        enabled = 'enabled' if sys._is_gil_enabled() else 'disabled'
+        build += ' (GIL {} at runtime)'.format(enabled)
+    return 'Python {} {}'.format(platform.python_version(), build)
+
+
+def threaded(test, times, threads):
+    """Render times templates with 1 to threads threads, and compare"""
+    print(gil_status())
+
+    base = None
+    count = 1
+    while True:
+        def work():
+            for _ in range(times // count):
+                test()
+
+        workers = [Thread(target=work) for _ in range(count)]
+        start = time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        rate = (times // count) * count / (time() - start)
+
+        base = base or rate
+        print('{:3} threads: {:10.0f} renders/s ({:.2f}x)'
+              .format(count, rate, rate / base))
+
+        if count >= threads:
+            break
+        count = min(count * 2, threads)
 
 
 if __name__ == '__main__':
-    try:
-        main(int(argv[1]))
-    except IndexError:
-        main(10000)
+    parser = ArgumentParser(description='Time rendering a template')
+    parser.add_argument('times', type=int, nargs='?', default=10000,
+                        help='How many times to render it')
+    parser.add_argument('--threads', type=int,
+                        help='Render from up to this many threads at once, '
+                             'and report the throughput')
+    args = parser.parse_args()
+    main(args.times, args.threads)
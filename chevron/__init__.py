@@ -1,5 +1,18 @@
 from .main import main, cli_main
-from .renderer import render
+from .renderer import render, render_prefix, compile_template, Template, \
+    RenderLimitError
 from .tokenizer import ChevronError
+from .analyzer import analyze, validate
+from .loader import Loader, ArchiveLoader
+from .incremental import Incremental
+from .columns import Columns
+from .compress import CompressedWriter
+from .cache import FragmentCache, MemoryCache, DirectoryCache
+from .stats import metrics, reset_metrics, write_metrics, footprint
 
-__all__ = ['main', 'render', 'cli_main', 'ChevronError']
+__all__ = ['main', 'render', 'render_prefix', 'cli_main', 'ChevronError',
+           'compile_template', 'Template', 'analyze', 'validate', 'Loader',
+           'ArchiveLoader', 'Incremental', 'RenderLimitError', 'Columns',
+           'CompressedWriter', 'FragmentCache', 'MemoryCache',
+           'DirectoryCache', 'metrics', 'reset_metrics', 'write_metrics',
+           'footprint']
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import collections
+import io
+from os import path
+
+try:
+    from .tokenizer import tokenize, ChevronError, LITERAL, VARIABLE, \
+        NO_ESCAPE, SECTION, INVERTED, END, PARTIAL, SET_DELIMITER, \
+        PARENT, BLOCK
+except (ValueError, SystemError):  # python 2
+    from tokenizer import tokenize, ChevronError, LITERAL, VARIABLE, \
+        NO_ESCAPE, SECTION, INVERTED, END, PARTIAL, SET_DELIMITER, \
+        PARENT, BLOCK
+
+
+# A tag found in a template
+#
+# key      -- The key of the tag (or the partial's name, or the delimiters)
+# tag_type -- The type of tag, as in tokenize
+# sections -- The keys of the sections the tag is in, outermost first
+# template -- The name of the partial the tag is in (None for the template)
+# line     -- The line the tag is on (starting at 1, None if unknown)
+# column   -- The column the tag starts at (starting at 1, None if unknown)
+# start    -- Where the tag starts in the template
+# stop     -- Where the tag stops in the template
+Reference = collections.namedtuple('Reference', [
+    'key', 'tag_type', 'sections', 'template',
+    'line', 'column', 'start', 'stop'])
+
+
+class TemplateInfo(object):
+    """Everything a template and its partials refer to
+
+    keys       -- References for every variable and section
+    sections   -- References for every section and inverted section
+    partials   -- References for every partial tag (and parent tag)
+    delimiters -- References for every set delimiter tag
+    missing    -- Names of the partials that could not be found
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.sections = []
+        self.partials = []
+        self.delimiters = []
+        self.missing = []
+
+    def key_paths(self):
+        """Get the set of dotted key paths the template could look up
+
+        Keys are qualified by the sections they're in, so {{name}} inside
+        of {{#people}} (or in a partial included there) is 'people.name'.
+        (It may really be a name from an outer scope, mustache can't know
+        until it has the data.)
+        """
+        paths = set()
+        for ref in self.keys:
+            keys = list(ref.sections)
+            if ref.key != '.':
+                keys.append(ref.key)
+            if keys:
+                paths.add('.'.join(keys))
+        return paths
+
+
+#
+# Helper functions
+#
+
+def _read(template):
+    """Get the text of a template"""
+    try:
+        return template.read()
+    except AttributeError:
+        return template
+
+
+def _find_partial(name, partials_dict, partials_path, partials_ext):
+    """Find a partial the way the renderer would, None if it can't
+
+    Returns its text, or its tokens if it was compiled already (and its
+    text can't be had, as it can from a Loader).
+    """
+    try:
+        partial = partials_dict[name]
+    except KeyError:
+        if partials_path is None or partials_path == '':
+            return None
+
+        path_ext = ('.' + partials_ext if partials_ext else '')
+        partial_path = path.join(partials_path, name + path_ext)
+        try:
+            with io.open(partial_path, 'r', encoding='utf-8') as partial:
+                return partial.read()
+        except IOError:
+            return None
+
+    if isinstance(partial, list):
+        try:
+            return partials_dict.get_source(name)
+        except AttributeError:
+            # (The template it was expanded from still has its parents)
+            return getattr(partial, 'source', None) or partial
+    return partial
+
+
+def _scan(info, name, text, def_ldel, def_rdel, outer=()):
+    """Add the tags of one template to info, returns its partials
+
+    text can be the template's tokens too, if it was compiled already
+    (its tags' lines and columns are None, then). outer are the sections
+    the template is included in, and the partials are returned with the
+    sections they're in.
+    """
+
+    # Where every line starts, to turn offsets into lines and columns
+    if isinstance(text, list):
+        tokens = text
+        line_starts = None
+    else:
+        tokens = tokenize(text, def_ldel, def_rdel)
+        line_starts = [0]
+        index = text.find('\n')
+        while index != -1:
+            line_starts.append(index + 1)
+            index = text.find('\n', index + 1)
+
+    partials = []
+    sections = list(outer)
+    # (Parents and blocks end like sections, but aren't any)
+    ends = []
+    for token in tokens:
+        if token.op == LITERAL:
+            continue
+
+        if token.op == END:
+            if ends.pop():
+                sections.pop()
+            continue
+
+        if line_starts is None or token.start is None:
+            line = column = None
+        else:
+            line = bisect.bisect_right(line_starts, token.start)
+            column = token.start - line_starts[line - 1] + 1
+        ref = Reference(token.key, token.tag_type, tuple(sections), name,
+                        line, column, token.start, token.stop)
+
+        if token.op in (VARIABLE, NO_ESCAPE):
+            info.keys.append(ref)
+
+        elif token.op in (SECTION, INVERTED):
+            info.keys.append(ref)
+            info.sections.append(ref)
+            sections.append(token.key)
+            ends.append(True)
+
+        elif token.op == PARTIAL:
+            info.partials.append(ref)
+            partials.append((token.key, tuple(sections)))
+
+        elif token.op == PARENT:
+            info.partials.append(ref)
+            partials.append((token.key, tuple(sections)))
+            ends.append(False)
+
+        elif token.op == BLOCK:
+            ends.append(False)
+
+        elif token.op == SET_DELIMITER:
+            info.delimiters.append(ref)
+
+    return partials
+
+
+#
+# The analyzing functions
+#
+
+def analyze(template, partials_path='.', partials_ext='mustache',
+            partials_dict={}, def_ldel='{{', def_rdel='}}'):
+    """Find everything a mustache template refers to, without rendering it
+
+    Partials are found the same way render finds them, and are analyzed
+    too (as are their partials, and so on).
+
+
+    Arguments:
+
+    template      -- A file-like object or a string containing the template
+
+    partials_path -- The path to where your partials are stored
+                     If set to None, then partials won't be loaded from
+                     the file system (defaults to '.')
+
+    partials_ext  -- The extension of your partials
+                     (defaults to 'mustache')
+
+    partials_dict -- A python dictionary which will be search for partials
+                     before the filesystem is (defaults to {})
+
+    def_ldel      -- The default left delimiter
+                     ("{{" by default, as in spec compliant mustache)
+
+    def_rdel      -- The default right delimiter
+                     ("}}" by default, as in spec compliant mustache)
+
+
+    Returns:
+
+    A TemplateInfo. A ChevronError is raised if the template or one of its
+    partials isn't valid (naming the partial it was found in).
+    """
+
+    info = TemplateInfo()
+    # (Partials are scanned once for every set of sections they're in,
+    # so their keys are qualified like the ones around them)
+    seen = set()
+    found = {}
+    # name, text, the sections it's in, the partials it's in
+    pending = collections.deque([(None, _read(template), (), ())])
+
+    while pending:
+        name, text, outer, including = pending.popleft()
+
+        try:
+            partials = _scan(info, name, text, def_ldel, def_rdel, outer)
+        except ChevronError as error:
+            if name is None:
+                raise
+            raise ChevronError('{0}\nin partial "{1}"'
+                               .format(error.args[0], name))
+
+        for partial, sections in partials:
+            # (A partial that includes itself was scanned already)
+            if partial in including or (partial, sections) in seen:
+                continue
+            seen.add((partial, sections))
+
+            if partial not in found:
+                found[partial] = _find_partial(partial, partials_dict,
+                                               partials_path, partials_ext)
+                if found[partial] is None:
+                    info.missing.append(partial)
+            if found[partial] is not None:
+                pending.append((partial, found[partial], sections,
+                                including + (partial,)))
+
+    return info
+
+
+def _check(args):
+    """Check a single template file, for validate"""
+    template, options = args
+    try:
+        with io.open(template, 'r', encoding='utf-8') as template_file:
+            analyze(template_file, **options)
+    except ChevronError as error:
+        return (template, error.args[0])
+    except IOError as error:
+        return (template, str(error))
+    return (template, None)
+
+
+def validate(templates, partials_path='.', partials_ext='mustache',
+             partials_dict={}, def_ldel='{{', def_rdel='}}', workers=None):
+    """Check template files (and their partials) for syntax errors
+
+    The templates are checked in parallel, by a pool of worker processes.
+
+
+    Arguments:
+
+    templates     -- A list of paths to template files
+
+    workers       -- How many processes to use, 1 checks the templates
+                     in this process (defaults to one per cpu)
+
+    The other arguments are the same as for analyze.
+
+
+    Returns:
+
+    A dictionary from the path of every template that isn't valid to
+    a description of what's wrong with it.
+    """
+
+    options = {
+        'partials_path': partials_path,
+        'partials_ext': partials_ext,
+        'partials_dict': partials_dict,
+        'def_ldel': def_ldel,
+        'def_rdel': def_rdel,
+    }
+    jobs = [(template, options) for template in templates]
+
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:  # python 2
+        workers = 1
+
+    if workers == 1 or len(jobs) < 2:
+        results = map(_check, jobs)
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(_check, jobs, chunksize=16))
+
+    return dict((template, error) for template, error in results
+                if error is not None)
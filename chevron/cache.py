@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from .renderer import python3, _utf8_size
+except (ValueError, SystemError):  # python 2
+    from renderer import python3, _utf8_size
+
+
+class MemoryCache(object):
+    """Rendered fragments kept in memory, forgetting the least recently used
+
+    Arguments:
+
+    max_bytes -- How much output to keep, in bytes (of utf-8) (defaults
+                 to 16MiB)
+
+    ttl       -- How many seconds a fragment is good for, None for as long
+                 as it's kept (defaults to None)
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        # key -> (when it expires, output, its size)
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a fragment's output, None if it isn't here (or expired)"""
+        with self._lock:
+            try:
+                expires, output, size = self._fragments.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and time.time() >= expires:
+                self.size -= size
+                return None
+
+            # (Back on the end, as the most recently used)
+            self._fragments[key] = (expires, output, size)
+            return output
+
+    def set(self, key, output):
+        """Keep a fragment's output, making room for it if need be"""
+        size = _utf8_size(output)
+        if size > self.max_bytes:
+            return
+
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            old = self._fragments.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+
+            while self._fragments and self.size + size > self.max_bytes:
+                self.size -= self._fragments.popitem(last=False)[1][2]
+
+            self._fragments[key] = (expires, output, size)
+            self.size += size
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self.size = 0
+
+
+class DirectoryCache(object):
+    """Rendered fragments kept as files in a directory
+
+    They're kept between runs (and shared by processes), and a fragment
+    expires ttl seconds after its file was written.
+
+
+    Arguments:
+
+    path -- The directory to keep them in (made if it isn't there)
+
+    ttl  -- How many seconds a fragment is good for, None for as long
+            as its file is there (defaults to None)
+    """
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        """Get a fragment's output, None if it isn't here (or expired)"""
+        file_path = self._file(key)
+        try:
+            if self.ttl is not None and \
+                    time.time() >= os.stat(file_path).st_mtime + self.ttl:
+                return None
+            with io.open(file_path, 'r', encoding='utf-8',
+                         newline='') as fragment:
+                return fragment.read()
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, output):
+        """Keep a fragment's output, in a file of its own"""
+        # Write it next to where it goes, then put it there in one go
+        # (so nobody ever reads half of it)
+        handle, temp_path = tempfile.mkstemp(dir=self.path, prefix='.')
+        try:
+            with io.open(handle, 'w', encoding='utf-8',
+                         newline='') as fragment:
+                fragment.write(output)
+            os.rename(temp_path, self._file(key))
+        except (IOError, OSError):
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+class FragmentCache(object):
+    """Keep the output of sections, so they don't have to be rendered again
+
+    section makes a lambda to put in the data, and the sections it's used
+    for are cached by a key, which is a template rendered where the
+    section is (so it can use the data there):
+
+    cache = FragmentCache(MemoryCache(ttl=300))
+    chevron.render('{{#products}}{{#tile}}...{{/tile}}{{/products}}', {
+        'products': products,
+        'tile': cache.section('{{id}}:{{updated_at}}'),
+    })
+
+    The key has to change whenever what the section renders does (only
+    the key and the section's text are looked at).
+
+
+    Arguments:
+
+    backend -- Where the output is kept, anything with get(key) and
+               set(key, output) (defaults to a MemoryCache)
+    """
+
+    def __init__(self, backend=None):
+        self.backend = MemoryCache() if backend is None else backend
+        self.hits = 0
+        self.misses = 0
+
+    def section(self, key):
+        """Make a lambda that caches the sections it's used for
+
+        Arguments:
+
+        key -- A template for the key, like '{{id}}:{{updated_at}}'
+
+
+        Returns:
+
+        A lambda, for the data
+        """
+        def cached(text, render):
+            digest = hashlib.sha1()
+            for part in (text, u'\0', render(key)):
+                if not isinstance(part, bytes):
+                    part = part.encode('utf-8')
+                digest.update(part)
+            fragment_key = digest.hexdigest()
+
+            output = self.backend.get(fragment_key)
+            if output is not None:
+                self.hits += 1
+                if python3:
+                    return output
+                else:  # python 2
+                    return output.encode('utf-8')
+
+            self.misses += 1
+            output = render(text)
+            if python3:
+                self.backend.set(fragment_key, output)
+            else:  # python 2
+                self.backend.set(fragment_key, output.decode('utf-8'))
+            return output
+
+        return cached
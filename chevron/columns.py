@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+from itertools import repeat
+
+try:
+    from collections.abc import Sequence
+except ImportError:  # python 2
+    from collections import Sequence
+
+try:
+    from itertools import izip as zip, imap as map  # python 2
+except ImportError:
+    pass
+
+
+class Columns(Sequence):
+    """Columnar data, to be used as the list of a list section
+
+    Rather than a list of rows, it's a mapping of column names to columns
+    (lists, tuples, array.arrays or numpy arrays, all the same length).
+    Each item of the section is a row, so {{name}} is the row's value
+    from the name column:
+
+    chevron.render('{{#people}}{{name}} is {{age}}\\n{{/people}}', {
+        'people': Columns({'name': names, 'age': ages})
+    })
+
+
+    Arguments:
+
+    columns -- A mapping of column names to columns
+
+    formats -- A mapping of column names to how to format their values,
+               either a format spec ('.2f') or a function. Columns with a
+               format are turned into strings all at once, up front.
+
+    A row is a small dictionary, made as the section gets to it (and
+    let go of after), so the rows never all exist at once.
+    """
+
+    __slots__ = ('columns', 'length')
+
+    def __init__(self, columns, formats=None):
+        self.columns = {}
+        for name, column in columns.items():
+            # Arrays (numpy's or array's) make python values in one go
+            if hasattr(column, 'tolist'):
+                column = column.tolist()
+
+            if formats and name in formats:
+                fmt = formats[name]
+                if callable(fmt):
+                    column = list(map(fmt, column))
+                else:
+                    column = [format(value, fmt) for value in column]
+
+            self.columns[name] = column
+
+        lengths = set(len(column) for column in self.columns.values())
+        if len(lengths) > 1:
+            raise ValueError('Columns must all be the same length, not {0}'
+                             .format(sorted(lengths)))
+        self.length = lengths.pop() if lengths else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('Columns index out of range')
+        return dict((name, column[index])
+                    for name, column in self.columns.items())
+
+    def __iter__(self):
+        # (All in C: zip the columns into rows, and each row with the names)
+        names = list(self.columns)
+        rows = zip(*[self.columns[name] for name in names])
+        return map(dict, map(zip, repeat(names), rows))
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return 'Columns({0!r})'.format(self.columns)
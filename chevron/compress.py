@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+
+
+def _gzip(level):
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _zlib(level):
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+
+
+def _deflate(level):
+    return zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+def _bz2(level):
+    import bz2
+    return bz2.BZ2Compressor(max(1, level))
+
+
+def _xz(level):
+    try:
+        import lzma
+    except ImportError:  # python 2
+        raise ValueError('xz compression needs the lzma module')
+    return lzma.LZMACompressor(preset=max(0, level))
+
+
+# How to start compressing, by format
+_COMPRESSORS = {
+    'gzip': _gzip,
+    'zlib': _zlib,
+    'deflate': _deflate,
+    'bz2': _bz2,
+    'xz': _xz,
+}
+
+# How much text is compressed at a time, by default
+CHUNK_SIZE = 64 * 1024
+
+
+class CompressedWriter(object):
+    """A file-like object that compresses what's written to it, as it goes
+
+    Give it to render as out, and the output is compressed while it's
+    being rendered, rather than all at the end:
+
+    with open('export.json.gz', 'wb') as file:
+        with CompressedWriter(file, 'gzip') as out:
+            chevron.render(template, data, out=out)
+
+    Text is saved up until there's chunk_size of it, and then encoded
+    and compressed in one go, so only about that much of the output is
+    in memory at once.
+
+
+    Arguments:
+
+    file       -- A binary file-like object to write the compressed output to
+
+    format     -- 'gzip', 'zlib', 'deflate' (raw), 'bz2' or 'xz'
+                  (defaults to 'gzip')
+
+    level      -- The compression level, -1 for the format's default
+                  (defaults to -1)
+
+    chunk_size -- How many characters to compress at a time
+                  (defaults to 64KiB)
+
+    encoding   -- How to encode the text (defaults to 'utf-8')
+
+    Closing it writes what's left, but doesn't close the file.
+    """
+
+    def __init__(self, file, format='gzip', level=-1, chunk_size=CHUNK_SIZE,
+                 encoding='utf-8'):
+        try:
+            start = _COMPRESSORS[format]
+        except KeyError:
+            formats = ', '.join(sorted(_COMPRESSORS))
+            raise ValueError('Unknown compression format {0!r}, expected '
+                             'one of {1}'.format(format, formats))
+
+        # (bz2 and xz have no -1, but the middle is their default)
+        if level == -1 and format in ('bz2', 'xz'):
+            level = 9 if format == 'bz2' else 6
+
+        self.file = file
+        self.format = format
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.closed = False
+        self._compressor = start(level)
+        self._pending = []
+        self._size = 0
+
+    def write(self, text):
+        """Compress text (or bytes) once there's a chunk of it"""
+        if self.closed:
+            raise ValueError('write to a closed CompressedWriter')
+        if text:
+            self._pending.append(text)
+            self._size += len(text)
+            if self._size >= self.chunk_size:
+                self._compress()
+
+    def _compress(self):
+        encoding = self.encoding
+        data = b''.join(part if isinstance(part, bytes)
+                        else part.encode(encoding)
+                        for part in self._pending)
+        self._pending = []
+        self._size = 0
+
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self.file.write(compressed)
+
+    def flush(self):
+        """Compress what's been written so far, and flush the file
+
+        (The output can be decompressed up to here, but flushing often
+        makes it compress worse. bz2 and xz can't be flushed part way.)
+        """
+        self._compress()
+        if self.format in ('gzip', 'zlib', 'deflate'):
+            self.file.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        if hasattr(self.file, 'flush'):
+            self.file.flush()
+
+    def close(self):
+        """Write the rest of the output, and the format's end"""
+        if self.closed:
+            return
+        self._compress()
+        self.file.write(self._compressor.flush())
+        if hasattr(self.file, 'flush'):
+            self.file.flush()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+
+try:
+    from .renderer import compile_template, _State, _RENDERERS, \
+        _render_tokens, _join, _to_unicode, _inherit, python3, MAX_DEPTH
+    from .stats import counters
+    from .tokenizer import LITERAL, VARIABLE, NO_ESCAPE, SECTION, \
+        INVERTED, PARTIAL, BLOCK
+except (ValueError, SystemError):  # python 2
+    from renderer import compile_template, _State, _RENDERERS, \
+        _render_tokens, _join, _to_unicode, _inherit, python3, MAX_DEPTH
+    from stats import counters
+    from tokenizer import LITERAL, VARIABLE, NO_ESCAPE, SECTION, \
+        INVERTED, PARTIAL, BLOCK
+
+
+# Reading this means reading all of the data (it overlaps every key path)
+_EVERYTHING = ()
+
+
+def _key_path(key):
+    """Split a dotted key into a tuple (keys may be tuples already)"""
+    if isinstance(key, tuple):
+        return key
+    return tuple(key.split('.'))
+
+
+def _overlaps(reads, changed):
+    """Check if any key path read is inside of a changed one, or around it"""
+    for read in reads:
+        for change in changed:
+            if read[:len(change)] == change or change[:len(read)] == read:
+                return True
+    return False
+
+
+def _changed_keys(old, new):
+    """Find the top level keys whose values differ, None for all of them"""
+    if not isinstance(old, Mapping) or not isinstance(new, Mapping):
+        return None
+
+    changed = set()
+    for key in set(old) | set(new):
+        if key not in old or key not in new:
+            changed.add(key)
+            continue
+
+        old_value, new_value = old[key], new[key]
+        if old_value is new_value:
+            continue
+        try:
+            # (1 == True, but they don't render the same)
+            if old_value != new_value or \
+                    type(old_value) is not type(new_value):
+                changed.add(key)
+        except (TypeError, ValueError):  # (no clear answer, like numpy's)
+            changed.add(key)
+
+    return changed
+
+
+class _Fragment(object):
+    """A top level tag of a template (and its section), and its output
+
+    reads    -- The key paths read rendering it the last time
+    volatile -- If it called a lambda (which could read anything)
+    tail     -- What was before it on its line, if it has partials
+                (their indentation depends on it)
+    """
+
+    __slots__ = ('start', 'stop', 'output', 'reads', 'volatile', 'tail')
+
+    def __init__(self, start, stop):
+        self.start = start
+        self.stop = stop
+        self.output = ''
+        self.reads = set()
+        self.volatile = False
+        self.tail = None
+
+
+class Incremental(object):
+    """A rendered template that can be updated by rendering only what changed
+
+    The template is split into its top level tags (sections and all), and
+    the data keys each one reads while it renders are recorded. Updating
+    with new data renders again only the tags that read a key that changed,
+    the rest of the output is kept:
+
+    page = Incremental(template, data)
+    page.text                                  # the whole output
+    page.update(new_data)                      # the new whole output
+    page.update(data, changed=['stats.count'])
+
+    Without changed, the top level values of the data are compared to the
+    ones from the last render to find what changed. Changes made in place
+    (like appending to a list that was already there) can't be seen that
+    way, so name them in changed. Tags that call lambdas are always
+    rendered again.
+
+
+    Arguments:
+
+    template -- A file-like object or a string containing the template
+                (or a Template)
+
+    data     -- A python dictionary with your data scope
+
+    The other keyword arguments are the same as for render.
+    """
+
+    def __init__(self, template, data={}, partials_path='.',
+                 partials_ext='mustache', partials_dict={}, def_ldel='{{',
+                 def_rdel='}}', warn=False, keep=False, max_depth=MAX_DEPTH):
+        self.options = (partials_path, partials_ext, partials_dict,
+                        def_ldel, def_rdel, warn, keep, max_depth)
+
+        # How many tags were rendered by the last update
+        self.rendered = 0
+
+        self._reads = None
+        self._volatile = False
+        self._partials = False
+        self._renderers = dict(_RENDERERS)
+        for op in (VARIABLE, NO_ESCAPE, SECTION, INVERTED, PARTIAL):
+            self._renderers[op] = self._tracking(_RENDERERS[op])
+
+        self.program = compile_template(template, def_ldel, def_rdel)
+        if self.program.inherits:
+            self.program = _inherit(self.program, self._new_state(data))
+
+        # Split the template into its top level tags
+        self.fragments = []
+        index = 0
+        while index < len(self.program):
+            token = self.program[index]
+            stop = index + 1
+            # (Indented blocks are rendered in one go, like sections)
+            if token.op in (SECTION, INVERTED) or \
+                    token.op == BLOCK and token.indent:
+                stop = min(index + token.end + 1, len(self.program))
+            self.fragments.append(_Fragment(index, stop))
+            index = stop
+
+        self._update(data, None)
+
+    @property
+    def text(self):
+        """The output of the last render"""
+        output = _join(fragment.output for fragment in self.fragments)
+        if python3:
+            return output
+        else:  # python 2
+            return output.encode('utf-8')
+
+    def _tracking(self, renderer):
+        """Wrap a tag renderer so it records what it reads"""
+        def track(state, program, index):
+            token = program[index]
+            if token.op == PARTIAL:
+                self._partials = True
+            elif token.key != '.':
+                self._reads.add(token.path or _key_path(token.key))
+                if token.op == SECTION and not self._volatile:
+                    # (A section that's a lambda calls it, and looking
+                    # its key up again would count as a second lookup)
+                    mine = counters()
+                    calls = mine.lambda_calls
+                    index = renderer(state, program, index)
+                    self._volatile = mine.lambda_calls != calls
+                    return index
+            elif all(scope is True for scope in state.scopes[1:]):
+                # {{.}} at the top is all of the data
+                # (inverted sections push True, but it isn't used)
+                self._reads.add(_EVERYTHING)
+            return renderer(state, program, index)
+        return track
+
+    def _new_state(self, data):
+        (partials_path, partials_ext, partials_dict,
+         def_ldel, def_rdel, warn, keep, max_depth) = self.options
+
+        state = _State([data], '', partials_path, partials_ext,
+                       partials_dict, def_ldel, def_rdel, warn, keep,
+                       max_depth)
+        state.renderers = self._renderers
+        return state
+
+    def _render_fragment(self, state, fragment, data, tail):
+        """Render a fragment again, tail is what's before it on its line"""
+
+        # Literals never change
+        if self.program[fragment.start].op == LITERAL:
+            fragment.output = _to_unicode(self.program[fragment.start].key)
+            return
+
+        # (Partials look back along the line for their indentation)
+        state.scopes = [data]
+        state.parts = [tail] if tail else []
+        self._reads = set()
+        self._volatile = False
+        self._partials = False
+
+        try:
+            _render_tokens(state, self.program, fragment.start,
+                           fragment.stop)
+        finally:
+            del state.frames[:]
+            reads, self._reads = self._reads, None
+
+        fragment.output = _join(state.parts[1 if tail else 0:])
+        fragment.reads = reads
+        fragment.volatile = self._volatile
+        fragment.tail = tail if self._partials else None
+        self.rendered += 1
+
+    def update(self, data=None, changed=None):
+        """Render the parts of the template that changed
+
+        Arguments:
+
+        data    -- The new data (defaults to the data of the last render)
+
+        changed -- The key paths that changed, as dotted strings
+                   ('stats.count') or tuples. If it isn't given, the data
+                   is compared to the last render's to find them
+
+
+        Returns:
+
+        The whole output, like text.
+        """
+        if data is None:
+            data = self.data
+
+        if changed is None:
+            changed = _changed_keys(self._snapshot, data)
+        if changed is not None:
+            changed = [_key_path(key) for key in changed]
+
+        self._update(data, changed)
+        return self.text
+
+    def _update(self, data, changed):
+        """Render the fragments that read something changed (all for None)"""
+        self.rendered = 0
+        state = None
+
+        tail = ''
+        for fragment in self.fragments:
+            if changed is None or fragment.volatile or \
+                    _overlaps(fragment.reads, changed) or \
+                    (fragment.tail is not None and fragment.tail != tail):
+                if state is None:
+                    state = self._new_state(data)
+                self._render_fragment(state, fragment, data, tail)
+
+            # Keep track of the line we're on
+            output = fragment.output
+            if '\n' in output:
+                tail = output.rpartition('\n')[2]
+            else:
+                tail += output
+
+        self.data = data
+        self._snapshot = dict(data) if isinstance(data, Mapping) else data
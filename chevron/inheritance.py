@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+try:
+    from .renderer import _compile
+    from .tokenizer import ChevronError, Token, LITERAL, VARIABLE, \
+        NO_ESCAPE, SECTION, INVERTED, END, PARTIAL, PARENT, BLOCK
+except (ValueError, SystemError):  # python 2
+    from renderer import _compile
+    from tokenizer import ChevronError, Token, LITERAL, VARIABLE, \
+        NO_ESCAPE, SECTION, INVERTED, END, PARTIAL, PARENT, BLOCK
+
+
+def _copy(token):
+    """Copy a tag, so it can be linked to its end tag somewhere else"""
+    copy = Token(token.op, token.key, token.start, token.stop)
+    copy.indent = token.indent
+    return copy
+
+
+def _blocks(program, start, stop):
+    """Find the blocks of a parent tag, by name
+
+    Anything else in a parent tag is ignored. Returns the block tags'
+    indexes.
+    """
+    blocks = {}
+    index = start
+    while index < stop:
+        token = program[index]
+        if token.op == BLOCK:
+            blocks.setdefault(token.key, (program, index))
+        if token.op in (SECTION, INVERTED, PARENT, BLOCK):
+            index += token.end + 1
+        else:
+            index += 1
+    return blocks
+
+
+def _indentation(program, start, stop, empty):
+    """Find how far the first line of program[start:stop] is indented
+
+    (For a block, where that's its own indentation. If it's empty it
+    has none of its own, and it's empty's.)
+    """
+    if start >= stop:
+        return empty
+    if program[start].op != LITERAL:
+        return ''
+    line = program[start].key.split('\n', 1)[0]
+    return line[:len(line) - len(line.lstrip(' \t'))]
+
+
+def _dedent(tokens, remove):
+    """Take remove off the start of each line (where it's there)"""
+    result = []
+    line_start = True
+    for token in tokens:
+        if token.op == LITERAL:
+            key = token.key
+            if line_start and key.startswith(remove):
+                key = key[len(remove):]
+            key = key.replace('\n' + remove, '\n')
+            if key:
+                line_start = key.endswith('\n')
+            token = Token(LITERAL, key, token.start, token.stop)
+
+        # (Tags that output something move us off the start of the line)
+        elif token.op in (VARIABLE, NO_ESCAPE, PARTIAL):
+            line_start = False
+
+        result.append(token)
+    return result
+
+
+def _flatten(program, start, stop, get_parent, overrides, parents, indent,
+             result):
+    """Add program[start:stop] to result, with its parents expanded
+
+    overrides are the blocks that are overridden, by name, and parents
+    are the parents being expanded (to catch the ones that never end).
+    """
+    index = start
+    while index < stop:
+        token = program[index]
+
+        if token.op == BLOCK:
+            end = index + token.end
+
+            # A block on lines of its own is indented like a partial,
+            # as far as what's in it is (or the block tag, if it's empty)
+            marker = _copy(token)
+            marker.indent = None
+            if indent and token.indent is not None:
+                marker.indent = _indentation(program, index + 1, end,
+                                             token.indent)
+
+            content = []
+            if token.key not in overrides:
+                # Render what's in the block
+                _flatten(program, index + 1, end, get_parent, overrides,
+                         parents, indent, content)
+                remove = marker.indent
+            else:
+                # Or what it was overridden with
+                # (but a block in there by the same name is only itself)
+                source, block = overrides[token.key]
+                inner = dict(overrides)
+                del inner[token.key]
+
+                _flatten(source, block + 1, block + source[block].end,
+                         get_parent, inner, parents, indent, content)
+                remove = None
+                if indent and source[block].indent is not None:
+                    remove = _indentation(source, block + 1,
+                                          block + source[block].end, '')
+
+            # (The indentation goes back on when it's rendered)
+            if remove:
+                content = _dedent(content, remove)
+            result.append(marker)
+            result.extend(content)
+            result.append(program[end])
+            index = end + 1
+
+        elif token.op == PARENT:
+            end = index + token.end
+
+            # The blocks of the outermost child win
+            blocks = _blocks(program, index + 1, end)
+            blocks.update(overrides)
+
+            expanding = (token.key, frozenset(
+                (name, id(source), block)
+                for name, (source, block) in blocks.items()))
+            if expanding in parents:
+                raise ChevronError('the parent "{0}" inherits from itself'
+                                   .format(token.key))
+
+            # (The parent as it was written, if it was expanded already)
+            parent = get_parent(token.key)
+            if parent.source is not None:
+                parent = parent.source
+
+            # A standalone parent is indented like a partial too, so it's
+            # in a block of its own (that nothing can override)
+            marker = Token(BLOCK, token.key, token.start, token.stop)
+            marker.indent = token.indent if indent else None
+            result.append(marker)
+            _flatten(parent, 0, len(parent), get_parent, blocks,
+                     parents | frozenset([expanding]), indent, result)
+            result.append(Token(END, token.key))
+
+            index = end + 1
+
+        else:
+            if token.op in (SECTION, INVERTED):
+                token = _copy(token)
+            result.append(token)
+            index += 1
+
+
+def flatten(program, get_parent):
+    """Expand the parent tags of a template into one template
+
+    A parent tag renders another template (the parent), with the blocks
+    in the parent tag in place of the parent's blocks by the same name:
+
+    {{<layout}}
+      {{$title}}My page{{/title}}
+    {{/layout}}
+
+    Parents can have parents of their own, and the blocks of the template
+    that's furthest down win. Doing this before rendering means layouts
+    cost nothing to render. The block tags that are left only render
+    what's in them (indented, if need be), and the template it was
+    expanded from is kept as its source, for when it's a parent itself.
+
+
+    Arguments:
+
+    program    -- A Template
+
+    get_parent -- A function that gets a parent's Template by its name
+
+
+    Returns:
+
+    A new Template, without parent tags
+    """
+    tokens = []
+    # (Minified templates have no indentation to speak of)
+    _flatten(program, 0, len(program), get_parent, {}, frozenset(),
+             program.minify is None, tokens)
+
+    result = _compile(tokens)
+    result.minify = program.minify
+    result.inherits = False
+    result.source = program
+    return result
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import threading
+import zipfile
+
+try:
+    from .renderer import render, _compile, _compile_source, _minified, \
+        _share
+    from .inheritance import flatten
+    from .stats import footprint
+except (ValueError, SystemError):  # python 2
+    from renderer import render, _compile, _compile_source, _minified, \
+        _share
+    from inheritance import flatten
+    from stats import footprint
+
+
+def _read_file(file_path):
+    with io.open(file_path, 'r', encoding='utf-8') as template_file:
+        return template_file.read()
+
+
+def _compile_text(args):
+    """Compile the text of a template"""
+    text, def_ldel, def_rdel, minify = args
+    program = _compile_source(text, def_ldel, def_rdel)
+    return _minified(program, minify)
+
+
+def _compile_file(args):
+    """Read and compile a template file"""
+    file_path, def_ldel, def_rdel, minify = args
+    return _compile_text((_read_file(file_path), def_ldel, def_rdel, minify))
+
+
+class Loader(object):
+    """A set of mustache templates, found in a list of directories
+
+    Every directory is scanned once, and the templates in it are named
+    by their path in the directory, without the extension (so
+    emails/welcome.mustache is 'emails/welcome'). When more than one
+    directory has a template with the same name, the one in the
+    earliest directory wins, so theme directories can override
+    templates by coming first.
+
+    Templates are read and compiled the first time they are used,
+    or all at once by preload. After that, looking a template up
+    (including partials that don't exist) never touches the filesystem.
+    Templates with parents ({{<layout}}) have them expanded as they're
+    compiled, so the loader's templates never need it when rendered.
+
+    A loader can be used as the partials_dict of render, and it renders
+    its templates with itself as the partials:
+
+    loader = Loader(['theme', 'templates'])
+    loader.preload()
+    loader.render('page', {...})
+
+
+    Arguments:
+
+    search_path -- A directory, or a list of directories to look in
+                   (defaults to '.')
+
+    ext         -- The extension of the template files
+                   (defaults to 'mustache')
+
+    def_ldel    -- The default left delimiter
+                   ("{{" by default, as in spec compliant mustache)
+
+    def_rdel    -- The default right delimiter
+                   ("}}" by default, as in spec compliant mustache)
+
+    minify      -- Minify the templates for 'html' or 'json' output, as
+                   they're compiled (defaults to None)
+    """
+
+    def __init__(self, search_path='.', ext='mustache',
+                 def_ldel='{{', def_rdel='}}', minify=None):
+        if isinstance(search_path, (list, tuple)):
+            self.search_path = list(search_path)
+        else:
+            self.search_path = [search_path]
+        self.ext = ext
+        self.def_ldel = def_ldel
+        self.def_rdel = def_rdel
+        self.minify = minify
+
+        # name -> the file the template is in
+        self._index = None
+        # name -> the compiled template
+        self._templates = {}
+
+    @classmethod
+    def from_package(cls, package, directory='templates', **kwargs):
+        """Get the templates in a directory of a python package
+
+        The package's resources are found with importlib.resources, so
+        this works for packages installed from a wheel, and for ones
+        imported from a zip file (whose templates are read from the
+        archive, with an ArchiveLoader).
+
+
+        Arguments:
+
+        package   -- The package (or its name)
+
+        directory -- The directory in the package the templates are in
+                     (defaults to 'templates')
+
+        The keyword arguments are passed on to the loader.
+        """
+        try:
+            from importlib.resources import files
+        except ImportError:  # python 3.8 and older
+            from importlib_resources import files
+
+        resources = files(package).joinpath(directory)
+        if isinstance(resources, getattr(zipfile, 'Path', ())):
+            return ArchiveLoader(resources.root.filename, resources.at,
+                                 **kwargs)
+        return Loader(str(resources), **kwargs)
+
+    #
+    # Finding templates
+    #
+
+    def scan(self):
+        """Find every template in the search path
+
+        This is done the first time a template is looked up, call it
+        again to find templates that have been added since. Templates
+        that were already compiled are forgotten.
+        """
+        suffix = '.' + self.ext if self.ext else ''
+        index = {}
+
+        for directory in self.search_path:
+            for name, location in self._walk(directory):
+                if not name.endswith(suffix):
+                    continue
+                if suffix:
+                    name = name[:-len(suffix)]
+
+                # Earlier directories win
+                index.setdefault(name, location)
+
+        self._index = index
+        self._templates = {}
+
+    def _walk(self, directory):
+        """Find the files in a directory, by their path in it"""
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                file_path = os.path.join(root, filename)
+                name = os.path.relpath(file_path, directory)
+                yield name.replace(os.sep, '/'), file_path
+
+    @property
+    def index(self):
+        """The name of every template, and the file it's in"""
+        if self._index is None:
+            self.scan()
+        return self._index
+
+    def names(self):
+        """Get the names of all the templates"""
+        return sorted(self.index)
+
+    def path(self, name):
+        """Get the file a template is in"""
+        return self.index[name]
+
+    #
+    # Getting templates
+    #
+
+    def get_template(self, name):
+        """Get a compiled template, raises KeyError if there isn't one"""
+        try:
+            return self._templates[name]
+        except KeyError:
+            compile_job, jobs = self._jobs([name])
+            template = compile_job(jobs[0])
+            self._templates[name] = template
+            return self._inherit(name, template)
+
+    def _inherit(self, name, template):
+        """Expand the parents of a template that was just compiled"""
+        if template.inherits:
+            # (It's there as it is until then, in case it's its own parent)
+            template = flatten(template, self._get_parent)
+            self._templates[name] = template
+        return template
+
+    def _get_parent(self, name):
+        try:
+            return self.get_template(name)
+        except KeyError:
+            return _compile([])
+
+    def get_source(self, name):
+        """Get the text of a template"""
+        return _read_file(self.path(name))
+
+    def _jobs(self, names):
+        """Get what compiles the templates, and what it needs for each
+
+        (The workers read the files themselves, so reading happens in
+        parallel too.)
+        """
+        return _compile_file, [(self.index[name], self.def_ldel,
+                                self.def_rdel, self.minify)
+                               for name in names]
+
+    def preload(self, workers=None, processes=False):
+        """Read and compile every template, in parallel
+
+        Arguments:
+
+        workers   -- How many workers to use, 1 loads the templates one
+                     after another (defaults to one per cpu)
+
+        processes -- Use a pool of processes instead of threads,
+                     so that tokenizing happens in parallel too
+                     (defaults to False)
+        """
+        names = [name for name in self.names()
+                 if name not in self._templates]
+        compile_job, jobs = self._jobs(names)
+
+        try:
+            from concurrent import futures
+        except ImportError:  # python 2
+            workers = 1
+
+        if workers == 1 or len(jobs) < 2:
+            templates = map(compile_job, jobs)
+        else:
+            if processes:
+                pool = futures.ProcessPoolExecutor(workers)
+            else:
+                pool = futures.ThreadPoolExecutor(workers)
+            with pool:
+                templates = list(pool.map(compile_job, jobs))
+
+            # (Templates from other processes share nothing until they do)
+            if processes:
+                templates = [_share(template) for template in templates]
+
+        templates = list(templates)
+        self._templates.update(zip(names, templates))
+        for name in names:
+            self._inherit(name, self._templates[name])
+
+    def footprint(self):
+        """Measure how much memory the compiled templates take
+
+        (Only the ones compiled so far, see chevron.footprint)
+        """
+        return footprint(list(self._templates.values()))
+
+    def __getitem__(self, name):
+        return self.get_template(name)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __len__(self):
+        return len(self.index)
+
+    #
+    # Rendering templates
+    #
+
+    def render(self, name, data={}, **kwargs):
+        """Render a template, with the loader's templates as its partials
+
+        The keyword arguments are passed on to render.
+        """
+        kwargs.setdefault('partials_dict', self)
+        kwargs.setdefault('partials_path', None)
+        kwargs.setdefault('def_ldel', self.def_ldel)
+        kwargs.setdefault('def_rdel', self.def_rdel)
+        return render(self.get_template(name), data, **kwargs)
+
+
+class ArchiveLoader(Loader):
+    """A set of mustache templates in a zip archive
+
+    It works like a Loader, with directories in the archive as its search
+    path. The archive is opened (and its index read) once, and stays open
+    until the loader is closed, so looking templates up never unpacks
+    anything to disk. Preloading reads every template in one pass over
+    the archive, in the order they're stored in.
+
+    with ArchiveLoader('templates.zip', ['theme', 'templates']) as loader:
+        loader.preload()
+        loader.render('page', {...})
+
+
+    Arguments:
+
+    archive     -- The path of the zip file, or a file-like object with it
+
+    search_path -- A directory in the archive, or a list of directories
+                   to look in (defaults to '', the whole archive)
+
+    The rest are the same as Loader's.
+    """
+
+    def __init__(self, archive, search_path='', ext='mustache',
+                 def_ldel='{{', def_rdel='}}', minify=None):
+        Loader.__init__(self, search_path, ext, def_ldel, def_rdel, minify)
+        self.archive = archive
+        self._zip = None
+        # (Reads from the one zip file take turns)
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self.archive)
+        return self._zip
+
+    def close(self):
+        """Close the archive (it's opened again if need be)"""
+        with self._lock:
+            if self._zip is not None:
+                self._zip.close()
+                self._zip = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def scan(self):
+        """Find every template in the search path
+
+        The archive is opened again, to find templates that have been
+        added since.
+        """
+        self.close()
+        Loader.scan(self)
+
+    def _walk(self, directory):
+        prefix = directory.strip('/')
+        if prefix:
+            prefix += '/'
+
+        with self._lock:
+            members = self._open().namelist()
+        for member in members:
+            if member.startswith(prefix) and not member.endswith('/'):
+                yield member[len(prefix):], member
+
+    def _read(self, members):
+        """Read members of the archive, in the order they're stored in"""
+        with self._lock:
+            archive = self._open()
+            order = sorted(range(len(members)), key=lambda i: archive.getinfo(
+                members[i]).header_offset)
+
+            texts = [None] * len(members)
+            for i in order:
+                texts[i] = archive.read(members[i]).decode('utf-8')
+        return texts
+
+    def get_source(self, name):
+        """Get the text of a template"""
+        return self._read([self.path(name)])[0]
+
+    def _jobs(self, names):
+        # (The templates are read here, all at once, and only compiled by
+        # the workers)
+        texts = self._read([self.index[name] for name in names])
+        return _compile_text, [(text, self.def_ldel, self.def_rdel,
+                                self.minify) for text in texts]
@@ -1,13 +1,21 @@
 #!/usr/bin/python
 
 import io
+import json
+import os
+import stat as stat_module
 import sys
+import zipfile
 
 try:
     from .renderer import render
+    from .loader import ArchiveLoader
+    from .compress import CompressedWriter, CHUNK_SIZE
     from .metadata import version
 except (ValueError, SystemError):  # python 2
     from renderer import render
+    from loader import ArchiveLoader
+    from compress import CompressedWriter, CHUNK_SIZE
     from metadata import version
 
 
@@ -16,8 +24,7 @@ def main(template, data=None, **kwargs):
         yaml_loader = kwargs.pop('yaml_loader', None) or 'SafeLoader'
 
         if data is not None:
-            with io.open(data, 'r', encoding='utf-8') as data_file:
-                data = _load_data(data_file, yaml_loader)
+            data = _load_data_file(data, yaml_loader)
         else:
             data = {}
 
@@ -27,17 +34,128 @@ def main(template, data=None, **kwargs):
         }
 
         args.update(kwargs)
+
+        # The partials can be in a zip archive
+        partials_path = args.get('partials_path')
+        if partials_path and _is_archive(partials_path):
+            with ArchiveLoader(partials_path,
+                               ext=args.get('partials_ext', 'mustache'),
+                               def_ldel=args.get('def_ldel', '{{'),
+                               def_rdel=args.get('def_rdel', '}}')) as loader:
+                args['partials_dict'] = loader
+                args['partials_path'] = None
+                return render(**args)
+
         return render(**args)
 
 
-def _load_data(file, yaml_loader):
+def _is_archive(path):
+    """Is path a zip archive (rather than a directory)"""
+    return os.path.isfile(path) and zipfile.is_zipfile(path)
+
+
+# Data files that have been loaded, by path
+_data_cache = {}
+
+# How many data files _data_cache holds on to
+DATA_CACHE_SIZE = 64
+
+
+def _load_data_file(data_path, yaml_loader='SafeLoader'):
+    """Load a data file, or get it from the cache if it hasn't changed
+
+    The data is cached by the file's path, modification time and size,
+    so loading the same file again is free. (The same object is returned
+    each time, so don't change it.) Pipes are never cached.
+    """
+    stat = os.stat(data_path)
+    if not stat_module.S_ISREG(stat.st_mode):
+        with io.open(data_path, 'r', encoding='utf-8') as data_file:
+            return _load_data(data_file, yaml_loader)
+
+    key = (getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size,
+           yaml_loader)
+    try:
+        cached_key, data = _data_cache[data_path]
+        if cached_key == key:
+            return data
+    except KeyError:
+        pass
+
+    with io.open(data_path, 'r', encoding='utf-8') as data_file:
+        data = _load_data(data_file, yaml_loader)
+
+    # Make room by forgetting the oldest file
+    if len(_data_cache) >= DATA_CACHE_SIZE and data_path not in _data_cache:
+        try:
+            del _data_cache[next(iter(_data_cache))]
+        except (KeyError, StopIteration):  # (someone beat us to it)
+            pass
+    _data_cache[data_path] = (key, data)
+    return data
+
+
+def _json_loads():
+    """Get the fastest json parser there is"""
+    for module in ('orjson', 'ujson'):
+        try:
+            return __import__(module).loads
+        except ImportError:
+            pass
+    return json.loads
+
+
+_fast_json_loads = _json_loads()
+
+
+def _load_json(text):
+    try:
+        return _fast_json_loads(text)
+    except ValueError:
+        # The fast parsers don't take everything json does (like NaN)
+        if _fast_json_loads is json.loads:
+            raise
+        return json.loads(text)
+
+
+def _load_yaml(text, yaml_loader):
     try:
         import yaml
-        loader = getattr(yaml, yaml_loader)  # not tested
-        return yaml.load(file, Loader=loader)  # not tested
     except ImportError:
-        import json
-        return json.load(file)
+        return _load_json(text)
+
+    # Use the C version of the loader, when libyaml is there
+    loader = getattr(yaml, 'C' + yaml_loader, None) or \
+        getattr(yaml, yaml_loader)  # not tested
+    try:
+        return yaml.load(text, Loader=loader)  # not tested
+    except yaml.YAMLError as error:
+        # (So broken data is a ValueError, like it is for json)
+        raise ValueError('invalid yaml data: {0}'.format(error))
+
+
+def _load_data(file, yaml_loader='SafeLoader'):
+    """Load json or yaml data from a file-like object
+
+    The format is found from the file's extension, or if it doesn't
+    have one we know, from what it starts with. Json is parsed by a
+    json parser, even though yaml could do it (yaml is a lot slower).
+    """
+    text = file.read()
+
+    ext = os.path.splitext(getattr(file, 'name', None) or '')[1].lower()
+    if ext == '.json':
+        return _load_json(text)
+    if ext in ('.yaml', '.yml'):
+        return _load_yaml(text, yaml_loader)
+
+    if text.lstrip()[:1] in ('{', '['):
+        try:
+            return _load_json(text)
+        except ValueError:
+            # yaml's flow style looks like json, but isn't
+            pass
+    return _load_yaml(text, yaml_loader)
 
 
 def cli_main():
@@ -52,7 +170,7 @@ def cli_main():
             return arg
 
     def is_dir(arg):
-        if not os.path.isdir(arg):
+        if not os.path.isdir(arg) and not _is_archive(arg):
             parser.error('The directory {0} does not exist!'.format(arg))
         else:
             return arg
@@ -62,8 +180,8 @@ def cli_main():
     parser.add_argument('-v', '--version', action='version',
                         version=version)
 
-    parser.add_argument('template', help='The mustache file',
-                        type=is_file_or_pipe)
+    parser.add_argument('template', help='The mustache file(s)',
+                        type=is_file_or_pipe, nargs='*')
 
     parser.add_argument('-d', '--data', dest='data',
                         help='The json data file',
@@ -73,7 +191,8 @@ def cli_main():
                         help=argparse.SUPPRESS)
 
     parser.add_argument('-p', '--path', dest='partials_path',
-                        help='The directory where your partials reside',
+                        help='The directory (or zip archive) where your\
+                              partials reside',
                         type=is_dir, default='.')
 
     parser.add_argument('-e', '--ext', dest='partials_ext',
@@ -93,12 +212,142 @@ def cli_main():
                         help='Print a warning to stderr for each undefined template key encountered',
                         action='store_true')
 
+    parser.add_argument('-m', '--minify', dest='minify',
+                        help='Minify the template\'s text (not the data)\
+                              for html or json output',
+                        choices=['html', 'json'])
+
+    parser.add_argument('--gzip', dest='gzip',
+                        help='Compress the output with gzip, as it\'s\
+                              rendered',
+                        action='store_true')
+
+    parser.add_argument('--chunk-size', dest='chunk_size',
+                        help='How many characters to compress at a time\
+                              with --gzip (64KiB by default)',
+                        type=int, default=CHUNK_SIZE)
+
+    parser.add_argument('-o', '--output-dir', dest='output_dir',
+                        help='Render each template to a file in this\
+                              directory (named after the template,\
+                              without its extension)')
+
+    parser.add_argument('--watch', dest='watch',
+                        help='Keep running, and render the templates\
+                              again whenever they, their partials or the\
+                              data change',
+                        action='store_true')
+
+    parser.add_argument('--interval', dest='interval',
+                        help='How often to check for changes when watching,\
+                              in seconds (0.5 by default)',
+                        type=float, default=0.5)
+
+    parser.add_argument('--serve', dest='serve', metavar='SOCKET',
+                        help='Keep running, and render templates for\
+                              --connect on this unix socket\
+                              (or stdin and stdout, for -)')
+
+    parser.add_argument('--connect', dest='connect', metavar='SOCKET',
+                        help='Have the server on this unix socket render\
+                              the template')
 
     args = vars(parser.parse_args())
+    templates = args.pop('template')
+    output_dir = args.pop('output_dir')
+    watch = args.pop('watch')
+    interval = args.pop('interval')
+    serve = args.pop('serve')
+    connect = args.pop('connect')
+    gzip = args.pop('gzip')
+    chunk_size = args.pop('chunk_size')
+
+    if serve is not None:
+        try:
+            from .server import Server
+        except (ValueError, SystemError):  # python 2
+            from server import Server
+
+        try:
+            Server().serve(serve)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if not templates:
+        parser.error('the following arguments are required: template')
+
+    if output_dir is not None:
+        if gzip:
+            parser.error('--gzip writes to stdout, not to an --output-dir')
+        if _is_archive(args['partials_path']):
+            parser.error('--output-dir needs a directory of partials, '
+                         'not a zip archive')
+        try:
+            from .watch import Watcher
+        except (ValueError, SystemError):  # python 2
+            from watch import Watcher
+
+        try:
+            watcher = Watcher(templates, output_dir, **args)
+        except ValueError as error:
+            parser.error(str(error))
+        if watch:
+            try:
+                watcher.watch(interval)
+            except KeyboardInterrupt:
+                return
+
+        watcher.build()
+        for template, error in sorted(watcher.errors.items()):
+            sys.stderr.write('Chevron: {0}: {1}\n'.format(template, error))
+        if watcher.errors:
+            sys.exit(1)
+        return
+
+    if watch:
+        parser.error('--watch needs an --output-dir to render to')
+    if len(templates) > 1:
+        parser.error('rendering more than one template needs an --output-dir')
+    args['template'] = templates[0]
+
+    # Compress the output as it's rendered, rather than all at the end
+    out = None
+    if gzip:
+        out = CompressedWriter(getattr(sys.stdout, 'buffer', sys.stdout),
+                               'gzip', chunk_size=chunk_size)
+
+    if connect is not None:
+        try:
+            from .server import request
+        except (ValueError, SystemError):  # python 2
+            from server import request
+
+        if args['yaml_loader'] is None:
+            del args['yaml_loader']
+        try:
+            response = request(connect, **args)
+        except (IOError, OSError) as error:
+            # (socket.error is one of these)
+            sys.exit('Chevron: could not reach the server at {0}: {1}'
+                     .format(connect, error))
+        if 'error' in response:
+            sys.exit('Chevron: ' + response['error'])
+        if out is not None:
+            out.write(response['output'])
+            out.close()
+        else:
+            sys.stdout.write(response['output'])
+            sys.stdout.flush()
+        return
 
     try:
-        sys.stdout.write(main(**args))
-        sys.stdout.flush()
+        if out is not None:
+            main(out=out, **args)
+            out.close()
+        else:
+            sys.stdout.write(main(**args))
+            sys.stdout.flush()
     except SyntaxError as e:
         print('Chevron: syntax error')
         sys.exit('    ' + '\n    '.join(e.args[0].split('\n')))
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+try:
+    from .renderer import _plan_flat
+    from .tokenizer import Token, LITERAL, VARIABLE, NO_ESCAPE, PARTIAL, \
+        PARENT
+except (ValueError, SystemError):  # python 2
+    from renderer import _plan_flat
+    from tokenizer import Token, LITERAL, VARIABLE, NO_ESCAPE, PARTIAL, \
+        PARENT
+
+
+#
+# HTML
+#
+
+# Where whitespace matters, and must be left alone
+_RAW_TAGS = re.compile(r'<(/?)(pre|textarea|script|style)\b', re.IGNORECASE)
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _collapse(match):
+    """Turn whitespace into one space, or one newline if it had any"""
+    return '\n' if '\n' in match.group() else ' '
+
+
+class _HTML(object):
+    """Collapse runs of whitespace into one, outside of <pre> and the like
+
+    Indentation and blank lines go, but lines stay lines, as they may
+    matter (to scripts, say).
+    """
+
+    def __init__(self):
+        # The tag whose whitespace we're leaving alone
+        self.raw = None
+
+    def __call__(self, text, line_start):
+        parts = []
+        pos = 0
+        for match in _RAW_TAGS.finditer(text):
+            closing, tag = match.group(1), match.group(2).lower()
+            if self.raw is None and not closing:
+                parts.append(self.collapse(text[pos:match.start()],
+                                           line_start and pos == 0))
+                pos = match.start()
+                self.raw = tag
+            elif self.raw == tag and closing:
+                parts.append(text[pos:match.start()])
+                pos = match.start()
+                self.raw = None
+
+        if self.raw is None:
+            parts.append(self.collapse(text[pos:], line_start and pos == 0))
+        else:
+            parts.append(text[pos:])
+        return ''.join(parts)
+
+    @staticmethod
+    def collapse(text, line_start):
+        # (Whitespace at the start of a line is indentation, or blank lines)
+        if line_start:
+            text = text.lstrip()
+        return _WHITESPACE.sub(_collapse, text)
+
+
+#
+# JSON
+#
+
+class _JSON(object):
+    """Drop the whitespace that isn't in a string"""
+
+    def __init__(self):
+        self.in_string = False
+        self.escaped = False
+
+    def __call__(self, text, line_start):
+        parts = []
+        for char in text:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in ' \t\r\n':
+                continue
+            parts.append(char)
+        return ''.join(parts)
+
+
+_MINIFIERS = {
+    'html': _HTML,
+    'json': _JSON,
+}
+
+
+def minify(program, mode):
+    """Minify the literals of a compiled template
+
+    Only the template's own text is touched, never what goes in its tags.
+    The literals are minified in order, so (for instance) a JSON string
+    that's opened in one literal and closed in another is left alone.
+    Partials are minified on their own though, so they can't know they're
+    in a <pre> (or a JSON string) of the template that includes them.
+
+
+    Arguments:
+
+    program -- A Template
+
+    mode    -- What the template makes, 'html' or 'json'
+
+
+    Returns:
+
+    A new Template (the tags are shared with the old one)
+    """
+    try:
+        minifier = _MINIFIERS[mode]()
+    except KeyError:
+        raise ValueError('Unknown minify mode {0!r}, expected one of {1}'
+                         .format(mode, ', '.join(sorted(_MINIFIERS))))
+
+    # Literals that become empty stay, so section ends don't move
+    result = type(program)()
+    line_start = True
+    for token in program:
+        if token.op == LITERAL:
+            text = minifier(token.key, line_start)
+            token = Token(LITERAL, text, token.start, token.stop)
+            if text:
+                line_start = text.endswith('\n')
+
+        # (Tags that output something move us off the start of the line)
+        elif token.op in (VARIABLE, NO_ESCAPE, PARTIAL, PARENT):
+            line_start = False
+
+        result.append(token)
+    result.minify = mode
+    result.inherits = program.inherits
+    result.flat = _plan_flat(result)
+    if program.source is not None:
+        result.source = minify(program.source, mode)
+    return result
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import io
+import os
+import threading
+import time
 from os import linesep, path
 
 try:
@@ -8,9 +11,15 @@ try:
 except ImportError:  # python 2
     from collections import Sequence, Iterator, Callable
 try:
-    from .tokenizer import tokenize
+    from .tokenizer import tokenize, Token, OPCODES, LITERAL, VARIABLE, \
+        NO_ESCAPE, SECTION, INVERTED, END, PARTIAL, SET_DELIMITER, \
+        PARENT, BLOCK
+    from .stats import counters, record_render, _clock as _timer
 except (ValueError, SystemError):  # python 2
-    from tokenizer import tokenize
+    from tokenizer import tokenize, Token, OPCODES, LITERAL, VARIABLE, \
+        NO_ESCAPE, SECTION, INVERTED, END, PARTIAL, SET_DELIMITER, \
+        PARENT, BLOCK
+    from stats import counters, record_render, _clock as _timer
 
 
 import sys
@@ -27,6 +36,54 @@ else:  # python 2
     unicode_type = unicode
     string_type = basestring  # noqa: F821 (This is defined in python2)
 
+try:
+    _RecursionError = RecursionError
+except NameError:  # python 2
+    _RecursionError = RuntimeError
+
+# How deep list sections and partials can be nested by default
+MAX_DEPTH = 1000
+
+# How long a list has to be before it's rendered in parallel by default
+PARALLEL_THRESHOLD = 10000
+
+# How many parts of the output can pile up before they're written to out
+FLUSH_PARTS = 1024
+
+try:
+    _clock = time.monotonic
+except AttributeError:  # python 2
+    _clock = time.time
+
+
+def _utf8_size(text):
+    """How many bytes text is, in utf-8"""
+    try:
+        if text.isascii():
+            return len(text)
+    except AttributeError:  # python 3.6 and older, and python 2
+        pass
+    return len(text.encode('utf-8'))
+
+
+class RenderLimitError(RuntimeError):
+    """A render went over one of its limits, and was stopped
+
+    limit -- Which limit it went over ('max_output_bytes',
+             'max_iterations' or 'deadline')
+    stats -- How far it got: a dictionary of the 'output' so far (in
+             bytes, of utf-8), the 'iterations' and the seconds 'elapsed'
+    """
+
+    def __init__(self, message, limit, stats):
+        # (Everything is in args, so it can come back from a process)
+        super(RenderLimitError, self).__init__(message, limit, stats)
+        self.limit = limit
+        self.stats = stats
+
+    def __str__(self):
+        return self.args[0]
+
 
 #
 # Helper functions
@@ -35,61 +92,87 @@ else:  # python 2
 def _html_escape(string):
     """HTML escape all of these " & < >"""
 
-    html_codes = {
-        '"': '&quot;',
-        '<': '&lt;',
-        '>': '&gt;',
-    }
-
     # & must be handled first
-    string = string.replace('&', '&amp;')
-    for char in html_codes:
-        string = string.replace(char, html_codes[char])
-    return string
+    return string.replace('&', '&amp;').replace('"', '&quot;') \
+        .replace('<', '&lt;').replace('>', '&gt;')
 
 
-def _get_key(key, scopes, warn, keep, def_ldel, def_rdel):
-    """Get a key from the current scope"""
+def _get_key(key, scopes, warn, keep, def_ldel, def_rdel, path=None,
+             memo=None):
+    """Get a key from the current scope
+
+    scopes is the scope stack, with the innermost scope last.
+
+    memo is a dictionary to remember keys found in outer scopes in (for
+    the rest of the render), so that looking them up again from a list
+    item doesn't mean missing in every scope in between.
+    """
 
     # If the key is a dot
     if key == '.':
         # Then just return the current scope
-        return scopes[0]
-
-    # Loop through the scopes
-    for scope in scopes:
+        return scopes[-1]
+
+    # Split the key on its dots (unless the tokenizer already did)
+    if path is None:
+        path = key.split('.')
+
+    # If we found the key before, and the scopes since can't have it
+    if memo is not None and key in memo:
+        depth, outer, thing = memo[key]
+        if depth < len(scopes) and scopes[depth] is outer and \
+                _unshadowed(path[0], scopes, depth + 1):
+            return thing
+
+    # Loop through the scopes, from the innermost out
+    depth = len(scopes)
+    for scope in reversed(scopes):
+        depth -= 1
         try:
             # For every dot seperated key
-            for child in key.split('.'):
+            for child in path:
                 # Move into the scope
-                try:
-                    # Try subscripting (Normal dictionaries)
-                    scope = scope[child]
-                except (TypeError, AttributeError):
+                if type(scope) not in _ATTRIBUTE_TYPES:
                     try:
-                        scope = getattr(scope, child)
+                        # Try subscripting (Normal dictionaries)
+                        scope = scope[child]
+                        continue
                     except (TypeError, AttributeError):
-                        # Try as a list
-                        scope = scope[int(child)]
+                        _learn_type(type(scope))
+
+                try:
+                    scope = getattr(scope, child)
+                except (TypeError, AttributeError):
+                    # Try as a list
+                    scope = scope[int(child)]
 
             # Return an empty string if falsy, with two exceptions
             # 0 should return 0, and False should return False
             if scope in (0, False):
-                return scope
-
-            try:
-                # This allows for custom falsy data types
-                # https://github.com/noahmorrison/chevron/issues/35
-                if scope._CHEVRON_return_scope_when_falsy:
-                    return scope
-            except AttributeError:
-                return scope or ''
+                thing = scope
+            else:
+                try:
+                    # This allows for custom falsy data types
+                    # https://github.com/noahmorrison/chevron/issues/35
+                    if not scope._CHEVRON_return_scope_when_falsy:
+                        continue
+                    thing = scope
+                except AttributeError:
+                    thing = scope or ''
         except (AttributeError, KeyError, IndexError, ValueError):
             # We couldn't find the key in the current scope
             # We'll try again on the next pass
-            pass
+            continue
+
+        # Remember keys from outer scopes (but not iterators, which
+        # would be used up by the first time)
+        if memo is not None and depth < len(scopes) - 1 and \
+                not isinstance(thing, Iterator):
+            memo[key] = (depth, scopes[depth], thing)
+        return thing
 
     # We couldn't find the key in any of the scopes
+    counters().missing_keys += 1
 
     if warn:
         sys.stderr.write("Could not find key '%s'%s" % (key, linesep))
@@ -100,6 +183,48 @@ def _get_key(key, scopes, warn, keep, def_ldel, def_rdel):
     return ''
 
 
+# Types that can't be subscripted by a key, so looking into them
+# goes straight to getattr (rather than raising and catching a
+# TypeError every time): objects without __getitem__ (like dataclasses
+# and classes with __slots__), and the sequences and strings that only
+# take numbers (like namedtuples, unless they change __getitem__)
+_ATTRIBUTE_TYPES = set()
+
+# Only so many are remembered, in case classes are made on the fly
+MAX_ATTRIBUTE_TYPES = 1024
+
+_NUMBER_GETITEMS = set(getattr(cls, '__getitem__', None) for cls in
+                       (list, tuple, str, unicode_type, bytes, bytearray))
+
+
+def _learn_type(cls):
+    """Remember cls, if subscripting it by a key always fails"""
+    getitem = getattr(cls, '__getitem__', None)
+    if getitem is None or getitem in _NUMBER_GETITEMS:
+        if len(_ATTRIBUTE_TYPES) >= MAX_ATTRIBUTE_TYPES:
+            _ATTRIBUTE_TYPES.clear()
+        _ATTRIBUTE_TYPES.add(cls)
+
+
+# The attributes of True (inverted sections push it as their scope)
+_TRUE_ATTRIBUTES = frozenset(dir(True))
+
+
+def _unshadowed(first, scopes, start):
+    """Check that scopes[start:] can't have a key starting with first
+
+    This is only sure for dictionaries (and True), anything else might.
+    """
+    for i in range(start, len(scopes)):
+        scope = scopes[i]
+        if type(scope) is dict:
+            if first in scope:
+                return False
+        elif scope is not True or first in _TRUE_ATTRIBUTES:
+            return False
+    return True
+
+
 def _get_partial(name, partials_dict, partials_path, partials_ext):
     """Load a partial"""
     try:
@@ -122,15 +247,1097 @@ def _get_partial(name, partials_dict, partials_path, partials_ext):
             return ''
 
 
+#
+# The rendering state
+#
+
+class _Limits(object):
+    """The limits of a render, and how close it is to them
+
+    They're checked as list items and partials start (every so many of
+    them), which is often enough to stop anything that goes on for too
+    long, without slowing down each tag.
+    """
+
+    __slots__ = ('max_output', 'max_iterations', 'deadline', 'started',
+                 'iterations', 'next_check', 'output', 'counted', 'flushed')
+
+    # How many iterations go by between checks
+    every = 16
+
+    def __init__(self, max_output, max_iterations, deadline):
+        self.max_output = max_output
+        self.max_iterations = max_iterations
+        self.started = _clock()
+        self.deadline = None if deadline is None else self.started + deadline
+        self.iterations = 0
+        self.next_check = 0
+        self.output = 0
+        self.counted = 0
+        # (What's been written to out already)
+        self.flushed = 0
+
+    def count(self, state):
+        """Count an iteration, and check the limits if it's time to"""
+        self.iterations += 1
+        if self.iterations < self.next_check:
+            return
+
+        if self.max_iterations is not None and \
+                self.iterations > self.max_iterations:
+            self.stop('max_iterations', state)
+        self.check(state)
+
+        # (Right on time for the iteration limit)
+        self.next_check = self.iterations + self.every
+        if self.max_iterations is not None:
+            self.next_check = min(self.next_check, self.max_iterations + 1)
+
+    def check(self, state):
+        """Check the limits, raises a RenderLimitError if one is over"""
+        if self.max_output is not None:
+            # Only count what's new (unless some was stripped off)
+            parts = state.parts
+            if len(parts) < self.counted:
+                self.output = self.counted = 0
+            for i in range(self.counted, len(parts)):
+                self.output += _utf8_size(parts[i])
+            self.counted = len(parts)
+
+            if self.output > self.max_output:
+                self.stop('max_output_bytes', state)
+
+        if self.deadline is not None and _clock() > self.deadline:
+            self.stop('deadline', state)
+
+    def stop(self, limit, state):
+        # (The output is only counted as it goes for max_output_bytes)
+        output = self.flushed + sum(_utf8_size(part) for part in state.parts)
+        stats = {
+            'output': output,
+            'iterations': self.iterations,
+            'elapsed': _clock() - self.started,
+        }
+        raise RenderLimitError('render stopped, {0} exceeded '
+                               '(output: {1}, iterations: {2})'
+                               .format(limit, output, self.iterations),
+                               limit, stats)
+
+
+class _State(object):
+    """Everything one call to render needs while it works
+
+    scopes is a stack with the innermost scope last, it is shared by
+    everything rendered in the call (sections push and pop their scope).
+
+    mark is where the output of the list item or partial being rendered
+    starts in parts, which is as far back as partials look to find
+    their indentation.
+
+    frames is the stack of list sections and partials being rendered.
+
+    renderers is the table of tag renderers, by opcode.
+
+    workers is how many processes render long lists (None for none),
+    parallel_threshold is how long is long.
+
+    limits are the _Limits of the render (None if it has none).
+
+    memo is where _get_key remembers keys found in outer scopes.
+
+    minify is how partials are minified (None for not at all).
+
+    out is where the output is written as it's rendered (None to keep
+    it all in parts), once parts gets to flush_at.
+    """
+
+    __slots__ = ('parts', 'mark', 'scopes', 'frames', 'max_depth',
+                 'padding', 'partials_path', 'partials_ext', 'partials_dict',
+                 'def_ldel', 'def_rdel', 'warn', 'keep', 'renderers',
+                 'workers', 'parallel_threshold', 'limits', 'memo',
+                 'minify', 'out', 'flush_at')
+
+    def __init__(self, scopes, padding, partials_path, partials_ext,
+                 partials_dict, def_ldel, def_rdel, warn, keep, max_depth):
+        self.parts = []
+        self.mark = 0
+        self.scopes = scopes
+        self.frames = []
+        self.max_depth = max_depth
+        self.padding = padding
+        self.partials_path = partials_path
+        self.partials_ext = partials_ext
+        self.partials_dict = partials_dict
+        self.def_ldel = def_ldel
+        self.def_rdel = def_rdel
+        self.warn = warn
+        self.keep = keep
+        self.renderers = _RENDERERS
+        self.workers = None
+        self.parallel_threshold = PARALLEL_THRESHOLD
+        self.limits = None
+        self.memo = {}
+        self.minify = None
+        self.out = None
+        self.flush_at = FLUSH_PARTS
+
+    def get_key(self, token):
+        return _get_key(token.key, self.scopes, self.warn, self.keep,
+                        self.def_ldel, self.def_rdel, token.path, self.memo)
+
+    def enter(self, program, start, stop):
+        """Push a frame to render program[start:stop] in"""
+
+        # The root frame doesn't count towards the depth
+        if self.max_depth is not None and \
+                len(self.frames) > self.max_depth:
+            raise _RecursionError('maximum render depth of {0} exceeded'
+                                  .format(self.max_depth))
+
+        if self.limits is not None:
+            self.limits.count(self)
+
+        frame = _Frame(program, start, stop, self.mark)
+        self.frames.append(frame)
+        self.mark = len(self.parts)
+        return frame
+
+    def leave(self, frame):
+        """Finish a frame, unless it's a list section with items left"""
+
+        # If we're a list section, move on to the next item
+        if frame.items is not None:
+            self.scopes.pop()
+            for thing in frame.items:
+                # There is nothing to render for falsy items
+                if thing:
+                    if self.limits is not None:
+                        self.limits.count(self)
+                    self.scopes.append(thing)
+                    self.mark = len(self.parts)
+                    frame.index = frame.start
+                    return
+
+        # If we're a partial, put the padding back
+        elif frame.padding is not None:
+            # And if the partial was indented
+            if frame.strip:
+                # then remove the spaces from the end
+                _rstrip_parts(self.parts, self.mark, ' \t')
+                # (and a block that rendered nothing takes its line back)
+                if frame.indent and len(self.parts) == self.mark:
+                    _rstrip_parts(self.parts, self.mark - 1, ' \t')
+                # (but a new line is still padded for the partial we're in)
+                if frame.padding and len(self.parts) > self.mark and \
+                        self.parts[-1].endswith('\n'):
+                    self.parts.append(frame.padding)
+            self.padding = frame.padding
+
+        self.mark = frame.mark
+        self.frames.pop()
+
+    def flush(self):
+        """Write the output so far to out, all but the end of the line
+
+        Partials look back along the line for their indentation (and
+        strip it off after), so whatever is after the last newline or
+        character that isn't whitespace stays in parts, and the marks
+        are moved to match.
+        """
+        parts = self.parts
+        point = _flush_point(parts)
+        if point is None:
+            self.flush_at = 2 * len(parts) + FLUSH_PARTS
+            return
+        end, offset = point
+
+        # (The limits count what's about to go)
+        if self.limits is not None:
+            self.limits.check(self)
+            self.limits.counted = max(0, self.limits.counted - end)
+
+        last = parts[end]
+        text = _join(parts[:end]) + last[:offset]
+        if self.limits is not None:
+            self.limits.flushed += _utf8_size(text)
+        parts[:end + 1] = [last[offset:]]
+
+        self.mark = max(0, self.mark - end)
+        for frame in self.frames:
+            frame.mark = max(0, frame.mark - end)
+        self.flush_at = len(parts) + FLUSH_PARTS
+
+        if text:
+            counters().output_bytes += len(text)
+            self.out.write(text if python3 else text.encode('utf-8'))
+
+    def render(self, template, data):
+        """Render a template for a lambda, with the current scopes"""
+        scopes = self.scopes[::-1]
+        if data:
+            scopes.insert(0, data)
+
+        max_depth = self.max_depth
+        if max_depth is not None:
+            max_depth -= len(self.frames) - 1
+
+        return render(template=template, scopes=scopes, padding=self.padding,
+                      partials_path=self.partials_path,
+                      partials_ext=self.partials_ext,
+                      partials_dict=self.partials_dict,
+                      def_ldel=self.def_ldel, def_rdel=self.def_rdel,
+                      warn=self.warn, keep=self.keep, max_depth=max_depth,
+                      minify=self.minify)
+
+
+class _Frame(object):
+    """Where we are in a program
+
+    List sections and partials get a frame instead of a recursive call,
+    it remembers what to put back once they're done.
+
+    items   -- What's left to loop over in a list section
+    mark    -- The mark to restore
+    padding -- The padding to restore after a partial
+    strip   -- If trailing spaces should be stripped after a partial
+    indent  -- The indentation an indented block put on its first line
+    """
+
+    __slots__ = ('program', 'index', 'start', 'stop', 'items', 'mark',
+                 'padding', 'strip', 'indent')
+
+    def __init__(self, program, start, stop, mark):
+        self.program = program
+        self.index = start
+        self.start = start
+        self.stop = stop
+        self.items = None
+        self.mark = mark
+        self.padding = None
+        self.strip = False
+        self.indent = None
+
+
+#
+# Compiling templates
+#
+
+class Template(list):
+    """A compiled template
+
+    A list of tokens, where every section knows where its end tag is.
+    It can be given to render (or used as a partial) instead of the
+    template's text, and it won't need to be tokenized again.
+
+    minify is how its literals were minified (None if they weren't).
+
+    inherits is whether it has parent (or block) tags, which are expanded
+    before it's rendered (see chevron.inheritance), and source is the
+    template it was expanded from (None if it wasn't).
+
+    flat is how to render it without the scope stack, if it's only text
+    and variables (None if it isn't).
+    """
+
+    __slots__ = ('minify', 'inherits', 'source', 'flat')
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.minify = None
+        self.inherits = False
+        self.source = None
+        self.flat = None
+
+
+# Templates compiled from strings, by (template, def_ldel, def_rdel, minify)
+_template_cache = {}
+
+# How many templates _template_cache holds on to
+CACHE_SIZE = 1024
+
+
+def _compile(tokens):
+    """Turn tokens into a Template, linking every section to its end tag"""
+
+    # Don't compile what has already been compiled
+    if isinstance(tokens, Template):
+        return tokens
+
+    program = Template()
+    open_sections = []
+    for token in tokens:
+        # Plain (tag_type, tag_key) tuples are welcome too
+        if not isinstance(token, Token):
+            token = Token(OPCODES[token[0]], token[1])
+
+        if token.op == SECTION or token.op == INVERTED:
+            open_sections.append(len(program))
+        elif token.op == PARENT or token.op == BLOCK:
+            open_sections.append(len(program))
+            program.inherits = True
+        elif token.op == END and open_sections:
+            start = open_sections.pop()
+            program[start].end = len(program) - start
+
+        program.append(token)
+
+    # Sections that are never closed run to the end
+    for start in open_sections:
+        program[start].end = len(program) - start
+
+    program.flat = _plan_flat(program)
+    return program
+
+
+# The tags a template can have and still be flat
+_FLAT_OPS = frozenset([LITERAL, VARIABLE, NO_ESCAPE, SET_DELIMITER])
+
+
+def _plan_flat(program):
+    """Plan how to render a template that's only text and variables
+
+    Returns a tuple of (op, text or key, path, the key if it has no dots)
+    for every literal and variable, or None if the template has anything
+    else in it (or {{.}}, which needs the scope stack).
+    """
+    plan = []
+    for token in program:
+        if token.op not in _FLAT_OPS or \
+                (token.op != LITERAL and token.key == '.'):
+            return None
+
+        if token.op == LITERAL:
+            key = token.key
+            if not isinstance(key, unicode_type):  # python 2
+                key = unicode(key, 'utf-8')
+            plan.append((LITERAL, key, None, None))
+        elif token.op != SET_DELIMITER:
+            simple = token.key if len(token.path) == 1 else None
+            plan.append((token.op, token.key, token.path, simple))
+    return tuple(plan)
+
+
+try:
+    _intern = sys.intern
+except AttributeError:  # python 2
+    _intern = intern  # noqa: F821 (This is defined in python2)
+
+# The paths of keys, by key, so templates with the same keys share them
+_shared_paths = {}
+
+# How many paths _shared_paths holds on to
+PATHS_SIZE = 16384
+
+
+def _share(program):
+    """Share the strings of a Template with the templates compiled before
+
+    Keys and literals are interned, so the same boilerplate in a thousand
+    templates is only in memory once (and so is the path of a key). Nothing
+    keeps interned strings alive but the templates that have them.
+    """
+    for token in program:
+        try:
+            token.key = _intern(token.key)
+        except TypeError:  # python 2, where unicode can't be interned
+            continue
+
+        if token.path is not None:
+            try:
+                token.path = _shared_paths[token.key]
+            except KeyError:
+                token.path = tuple(_intern(part) for part in token.path)
+
+                # Make room by forgetting the oldest path
+                if len(_shared_paths) >= PATHS_SIZE:
+                    try:
+                        del _shared_paths[next(iter(_shared_paths))]
+                    except (KeyError, StopIteration, RuntimeError):
+                        # (someone beat us to it, or is changing it as we look)
+                        pass
+                _shared_paths[token.key] = token.path
+
+    # (The plan has the strings in it too)
+    if program.flat is not None:
+        program.flat = _plan_flat(program)
+    return program
+
+
+def _compile_source(template, def_ldel, def_rdel):
+    """Tokenize and compile a template's text (counting the time it took)"""
+    started = _timer()
+    program = _share(_compile(tokenize(template, def_ldel, def_rdel)))
+
+    mine = counters()
+    mine.tokens += len(program)
+    mine.tokenize_seconds += _timer() - started
+    return program
+
+
+def compile_template(template, def_ldel='{{', def_rdel='}}', minify=None):
+    """Compile a mustache template
+
+    Templates given as strings are cached, so compiling (or rendering)
+    the same string again doesn't tokenize it again.
+
+
+    Arguments:
+
+    template -- A file-like object, a string containing the template,
+                or a list of tokens
+
+    def_ldel -- The default left delimiter
+                ("{{" by default, as in spec compliant mustache)
+
+    def_rdel -- The default right delimiter
+                ("}}" by default, as in spec compliant mustache)
+
+    minify   -- Minify the template's text for 'html' or 'json' output,
+                None to leave it as it is (see chevron.minify)
+
+
+    Returns:
+
+    A Template
+    """
+
+    # If the template is a sequence but not derived from a string
+    if isinstance(template, Sequence) and \
+            not isinstance(template, string_type):
+        # Then we don't need to tokenize it
+        # (And Templates, which are used again, keep their minified copy)
+        program = _compile(template)
+        return _minified(program, minify, program is template)
+
+    # File-like objects can't be cached
+    if not isinstance(template, string_type):
+        return _minified(_compile_source(template, def_ldel, def_rdel),
+                         minify)
+
+    key = (template, def_ldel, def_rdel, minify)
+    try:
+        program = _template_cache[key]
+        counters().template_cache_hits += 1
+        return program
+    except KeyError:
+        counters().template_cache_misses += 1
+        program = _minified(_compile_source(template, def_ldel, def_rdel),
+                            minify)
+
+        # Make room by forgetting the oldest template
+        if len(_template_cache) >= CACHE_SIZE:
+            try:
+                del _template_cache[next(iter(_template_cache))]
+            except (KeyError, StopIteration, RuntimeError):
+                # (someone beat us to it, or is changing it as we look)
+                pass
+        _template_cache[key] = program
+        return program
+
+
+# Minified copies of Templates, by (id(template), minify)
+# (The template is kept too, so its id can't be reused)
+_minified_cache = {}
+
+
+def _minified(program, mode, cache=False):
+    """Minify a Template, unless it doesn't need it"""
+    if mode is None or program.minify is not None:
+        return program
+
+    key = (id(program), mode)
+    if cache:
+        try:
+            return _minified_cache[key][1]
+        except KeyError:
+            pass
+
+    try:
+        from .minify import minify
+    except (ValueError, SystemError):  # python 2
+        from minify import minify
+    minified = _share(minify(program, mode))
+
+    if cache:
+        # Make room by forgetting the oldest template
+        if len(_minified_cache) >= CACHE_SIZE:
+            try:
+                del _minified_cache[next(iter(_minified_cache))]
+            except (KeyError, StopIteration, RuntimeError):
+                # (someone beat us to it, or is changing it as we look)
+                pass
+        _minified_cache[key] = (program, minified)
+    return minified
+
+
+# Templates with their parents expanded, by id(template)
+# (The template and its parents are kept too, to know if it's still good)
+_inherited_cache = {}
+
+
+def _inherit(program, state, cache=True):
+    """Expand the parents of a Template, with the partials of a render"""
+    def get_parent(name):
+        partial = _get_partial(name, state.partials_dict,
+                               state.partials_path, state.partials_ext)
+        return compile_template(partial, state.def_ldel, state.def_rdel,
+                                state.minify)
+
+    # It's still good if its parents are still the same
+    key = id(program)
+    try:
+        if not cache:
+            raise KeyError(key)
+        template, parents, inherited = _inherited_cache[key]
+        if template is program and all(get_parent(name) is parent
+                                       for name, parent in parents):
+            return inherited
+    except KeyError:
+        pass
+
+    try:
+        from .inheritance import flatten
+    except (ValueError, SystemError):  # python 2
+        from inheritance import flatten
+
+    parents = []
+
+    def get_new_parent(name):
+        parent = get_parent(name)
+        parents.append((name, parent))
+        return parent
+
+    inherited = flatten(program, get_new_parent)
+    if not cache:
+        return inherited
+
+    # Make room by forgetting the oldest template
+    if len(_inherited_cache) >= CACHE_SIZE and key not in _inherited_cache:
+        try:
+            del _inherited_cache[next(iter(_inherited_cache))]
+        except (KeyError, StopIteration, RuntimeError):
+            # (someone beat us to it, or is changing it as we look)
+            pass
+    _inherited_cache[key] = (program, tuple(parents), inherited)
+    return inherited
+
+
+def _to_unicode(thing):
+    if not isinstance(thing, unicode_type):
+        thing = unicode(str(thing), 'utf-8')
+    return thing
+
+
+def _join(parts):
+    return unicode('', 'utf-8').join(parts)
+
+
+def _render_tokens(state, program, start, stop):
+    """Render program[start:stop]
+
+    This is a loop rather than a recursion: when a tag renderer enters
+    a list section or a partial it pushes a frame, which is rendered
+    until it's done before we go back to the frame below it.
+    """
+    renderers = state.renderers
+    frames = state.frames
+    base = len(frames)
+
+    # (Anything already output is on the same line, for partials)
+    mark = state.mark
+    state.enter(program, start, stop)
+    state.mark = mark
+
+    while len(frames) > base:
+        frame = frames[-1]
+        program = frame.program
+        index = frame.index
+        stop = frame.stop
+        depth = len(frames)
+
+        while index < stop and len(frames) == depth:
+            index = renderers[program[index].op](state, program, index)
+        frame.index = index
+
+        # If the frame is done (and didn't just push a new one)
+        if index >= stop and len(frames) == depth:
+            state.leave(frame)
+
+        # Write out what's been rendered so far, if there's a lot of it
+        if state.out is not None and len(state.parts) >= state.flush_at:
+            state.flush()
+
+
+# How many tokens of a file-like template are rendered at a time
+STREAM_TOKENS = 256
+
+# The tags that have an end tag
+_OPENING = frozenset([SECTION, INVERTED, PARENT, BLOCK])
+
+
+def _render_stream(state, template):
+    """Render a file-like template as it's tokenized
+
+    The tokens are rendered a batch at a time, so only a batch (or the
+    section that's being read, which has to be there to be looped over)
+    is ever in memory, rather than the whole template.
+    """
+    mine = counters()
+    tokens = []
+    depth = 0
+
+    stream = tokenize(template, state.def_ldel, state.def_rdel)
+    while True:
+        started = _timer()
+        try:
+            token = next(stream)
+        except StopIteration:
+            break
+        finally:
+            mine.tokenize_seconds += _timer() - started
+        mine.tokens += 1
+
+        tokens.append(token)
+        if token.op in _OPENING:
+            depth += 1
+        elif token.op == END and depth:
+            depth -= 1
+
+        # Render what's been read, once it's not in a section
+        if not depth and len(tokens) >= STREAM_TOKENS:
+            _render_batch(state, tokens)
+            tokens = []
+
+    _render_batch(state, tokens)
+
+
+def _render_batch(state, tokens):
+    """Render some of the tokens of a template, after the ones before"""
+    program = _compile(tokens)
+    if program.inherits:
+        program = _inherit(program, state, cache=False)
+    _render_tokens(state, program, 0, len(program))
+
+
+#
+# The tag renderers
+#
+# Each one renders the token at program[index] and returns the index
+# of the next token to render.
+#
+
+# The types a variable is rendered as it is, when it's in a dict
+_PLAIN_TYPES = frozenset([unicode_type, int, float])
+
+_MISSING = object()
+
+
+def _render_flat(plan, data, warn, keep, def_ldel, def_rdel):
+    """Render a template that's only text and variables (see _plan_flat)"""
+    parts = []
+    lookup = data if type(data) is dict else None
+    for op, key, key_path, simple in plan:
+        if op == LITERAL:
+            parts.append(key)
+            continue
+
+        # Plain values straight from a dict are used as they are
+        thing = _MISSING
+        if lookup is not None and simple is not None:
+            thing = lookup.get(simple, _MISSING)
+            if type(thing) not in _PLAIN_TYPES:
+                thing = _MISSING
+        if thing is _MISSING:
+            thing = _get_key(key, [data], warn, keep, def_ldel, def_rdel,
+                             key_path)
+
+        if not isinstance(thing, unicode_type):
+            thing = unicode(str(thing), 'utf-8')
+        if op == VARIABLE:
+            thing = _html_escape(thing)
+        parts.append(thing)
+    return _join(parts)
+
+
+def _render_literal(state, program, index):
+    # Add padding to the key and add it to the output
+    key = program[index].key
+    if not isinstance(key, unicode_type):  # python 2
+        key = unicode(key, 'utf-8')
+    if state.padding:
+        key = key.replace('\n', '\n' + state.padding)
+    state.parts.append(key)
+    return index + 1
+
+
+def _render_variable(state, program, index):
+    # Add the html escaped key to the output
+    token = program[index]
+    thing = _get_key(token.key, state.scopes, state.warn, state.keep,
+                     state.def_ldel, state.def_rdel, token.path, state.memo)
+    if thing is True and token.key == '.':
+        # if we've coerced into a boolean by accident
+        # (inverted tags do this)
+        # then get the un-coerced object (next in the stack)
+        thing = state.scopes[-2]
+    if not isinstance(thing, unicode_type):
+        thing = unicode(str(thing), 'utf-8')
+    state.parts.append(_html_escape(thing))
+    return index + 1
+
+
+def _render_no_escape(state, program, index):
+    # Just lookup the key and add it
+    thing = state.get_key(program[index])
+    state.parts.append(_to_unicode(thing))
+    return index + 1
+
+
+def _render_section(state, program, index):
+    token = program[index]
+    end = index + token.end
+
+    # Get the sections scope
+    scope = state.get_key(token)
+
+    # If the scope is a callable (as described in
+    # https://mustache.github.io/mustache.5.html)
+    if isinstance(scope, Callable):
+        _render_lambda(state, scope, program[index + 1:end])
+
+    # If the scope is a sequence, an iterator or generator but not
+    # derived from a string
+    elif isinstance(scope, (Sequence, Iterator)) and \
+            not isinstance(scope, string_type):
+        # Long enough lists can be split between processes
+        if state.workers is not None and isinstance(scope, Sequence) and \
+                len(scope) >= state.parallel_threshold and \
+                _render_parallel(state, scope, program, index, end):
+            return end + 1
+
+        # Then we need to do some looping
+        items = iter(scope)
+
+        # Starting from the first item (that isn't falsy)
+        for thing in items:
+            if thing:
+                # Push it as the most recent scope and render the section
+                # (leaving the frame moves on to the other items)
+                frame = state.enter(program, index + 1, end)
+                frame.items = items
+                state.scopes.append(thing)
+                break
+
+    # If the scope is falsy
+    elif not scope:
+        # Then there is nothing in the section to render
+        pass
+
+    else:
+        # Otherwise we're just a scope section
+        state.scopes.append(scope)
+        return index + 1
+
+    # Skip over the section, and its end tag
+    return end + 1
+
+
+# What the processes rendering a list section in parallel work on:
+# the state to render with, the program, where the section's body is,
+# and the list. They get it by being forked, so it's never pickled.
+_parallel_job = None
+_parallel_lock = threading.Lock()
+
+
+def _fork_pool(workers):
+    """Start a pool of forked processes, None if we can't"""
+    import multiprocessing
+    try:
+        return multiprocessing.get_context('fork').Pool(workers)
+    except AttributeError:  # python 2 (which forks, if it can)
+        if not hasattr(os, 'fork'):
+            return None
+        return multiprocessing.Pool(workers)
+    except (ValueError, AssertionError):
+        # There is no fork here, or we're in a pool's process already
+        return None
+
+
+def _render_chunk(bounds):
+    """Render the list items from start to stop, in a pool's process"""
+    state, program, start, stop, items = _parallel_job
+    parts = state.parts = []
+    for i in range(*bounds):
+        thing = items[i]
+        # There is nothing to render for falsy items
+        if thing:
+            state.scopes.append(thing)
+            state.mark = len(parts)
+            _render_tokens(state, program, start, stop)
+            state.scopes.pop()
+    return _join(parts)
+
+
+def _render_parallel(state, scope, program, index, end):
+    """Render a list section with a pool of processes
+
+    The list is split into chunks which are rendered by the processes,
+    and the output is put together in order. Returns False if there
+    can't be a pool, so the list should be rendered as usual.
+    """
+    global _parallel_job
+
+    # The processes don't go as deep as we've gone already
+    max_depth = state.max_depth
+    if max_depth is not None:
+        if len(state.frames) > max_depth:
+            raise _RecursionError('maximum render depth of {0} exceeded'
+                                  .format(max_depth))
+        max_depth -= len(state.frames)
+
+    child = _State(list(state.scopes), state.padding, state.partials_path,
+                   state.partials_ext, state.partials_dict, state.def_ldel,
+                   state.def_rdel, state.warn, state.keep, max_depth)
+    child.renderers = state.renderers
+    limits = state.limits
+    if limits is not None and limits.deadline is not None:
+        # (The processes can only keep to the deadline, the parent
+        # counts the rest as the chunks come back)
+        child.limits = _Limits(None, None, None)
+        child.limits.started = limits.started
+        child.limits.deadline = limits.deadline
+
+    # (Only one job at a time, since it's in a global)
+    with _parallel_lock:
+        _parallel_job = (child, program, index + 1, end, scope)
+        try:
+            pool = _fork_pool(state.workers)
+        finally:
+            _parallel_job = None
+    if pool is None:
+        return False
+
+    # A few chunks per process, so they finish at about the same time
+    size = len(scope)
+    chunk_size = max(1, -(-size // (state.workers * 4)))
+    chunks = [(start, min(start + chunk_size, size))
+              for start in range(0, size, chunk_size)]
+
+    try:
+        for (start, stop), part in zip(chunks,
+                                       pool.imap(_render_chunk, chunks)):
+            state.parts.append(part)
+            if limits is not None:
+                limits.iterations += stop - start
+                limits.next_check = 0
+                limits.count(state)
+            if state.out is not None:
+                state.flush()
+    finally:
+        pool.terminate()
+        pool.join()
+    return True
+
+
+def _render_lambda(state, scope, tags):
+    def_ldel, def_rdel = state.def_ldel, state.def_rdel
+
+    # Generate template text from tags
+    text = unicode('', 'utf-8')
+    for tag in tags:
+        if tag.op == LITERAL:
+            text += tag.key
+        elif tag.op == NO_ESCAPE:
+            text += "%s& %s %s" % (def_ldel, tag.key, def_rdel)
+        else:
+            text += "%s%s %s%s" % (def_ldel, _TAG_CHARS[tag.op],
+                                   tag.key, def_rdel)
+
+    # If the lambda renders its own text, render the tags it came from
+    # (they're linked to their end tags already, and had their parents
+    # expanded, so they're a Template as they are)
+    program = Template(tags)
+    program.minify = state.minify
+
+    def render_text(template, data=None):
+        if template == text:
+            template = program
+        return state.render(template, data)
+
+    mine = counters()
+    mine.lambda_calls += 1
+    mine.nested += 1
+    try:
+        rend = scope(text, render_text)
+    finally:
+        mine.nested -= 1
+
+    if python3:
+        state.parts.append(rend)
+    else:  # python 2
+        state.parts.append(rend.decode('utf-8'))
+
+
+# What goes in front of a tag's key when lambdas get their text
+_TAG_CHARS = {
+    VARIABLE: '',
+    SECTION: '#',
+    INVERTED: '^',
+    END: '/',
+    PARTIAL: '>',
+    SET_DELIMITER: '=',
+    PARENT: '<',
+    BLOCK: '$',
+}
+
+
+def _render_inverted(state, program, index):
+    # If the scope is truthy there is nothing to render
+    token = program[index]
+    if state.get_key(token):
+        return index + token.end + 1
+
+    # Otherwise add the flipped scope to the scopes
+    state.scopes.append(True)
+    return index + 1
+
+
+def _render_end(state, program, index):
+    # Pop out of the latest scope
+    state.scopes.pop()
+    return index + 1
+
+
+def _render_partial(state, program, index):
+    # Load the partial
+    partial = _get_partial(program[index].key, state.partials_dict,
+                           state.partials_path, state.partials_ext)
+
+    # Find what to pad the partial with
+    # (a new line has the padding of the partial we're in on it already)
+    left, newline = _line_tail(state.parts, state.mark)
+    if newline and left.startswith(state.padding):
+        left = left[len(state.padding):]
+
+    # (Counting whether it was compiled already)
+    if isinstance(partial, string_type) and (
+            partial, state.def_ldel, state.def_rdel,
+            state.minify) not in _template_cache:
+        counters().partial_cache_misses += 1
+    else:
+        counters().partial_cache_hits += 1
+
+    # Render the partial, right into our output
+    part = compile_template(partial, state.def_ldel, state.def_rdel,
+                            state.minify)
+    if part.inherits:
+        part = _inherit(part, state)
+    frame = state.enter(part, 0, len(part))
+    frame.padding = state.padding
+    if left.isspace():
+        frame.strip = True
+        state.padding += left
+
+    return index + 1
+
+
+def _render_parent(state, program, index):
+    # (Templates have their parents expanded before they're rendered,
+    # this is for the ones that somehow weren't)
+    token = program[index]
+    part = Template(program[index:index + token.end + 1])
+    part.inherits = True
+    part = _inherit(part, state, cache=False)
+    state.enter(part, 0, len(part))
+    return index + token.end + 1
+
+
+def _render_block(state, program, index):
+    token = program[index]
+
+    # If the block is indented, render it like an indented partial
+    # (with the indentation on the line before it, like a partial's)
+    if token.indent:
+        state.parts.append(token.indent)
+        frame = state.enter(program, index + 1, index + token.end)
+        frame.padding = state.padding
+        frame.strip = True
+        frame.indent = token.indent
+        state.padding += token.indent
+        return index + token.end + 1
+
+    # Otherwise render what's in it, in the same scope
+    # (its end tag pops a scope, like a section's)
+    state.scopes.append(state.scopes[-1])
+    return index + 1
+
+
+def _render_set_delimiter(state, program, index):
+    # The tokenizer already took care of these
+    return index + 1
+
+
+def _line_tail(parts, start):
+    """Get what has been output since the last newline (or start)
+
+    Returns it, and whether there was a newline.
+    """
+    for i in range(len(parts) - 1, start - 1, -1):
+        if '\n' in parts[i]:
+            return (parts[i].rpartition('\n')[2] + _join(parts[i + 1:]),
+                    True)
+    return _join(parts[start:]), False
+
+
+def _flush_point(parts):
+    """Find the last newline or character that isn't whitespace
+
+    Returns (the index of its part, its index in the part), or None if
+    there isn't one.
+    """
+    for i in range(len(parts) - 1, -1, -1):
+        part = parts[i]
+        for j in range(len(part) - 1, -1, -1):
+            if part[j] == '\n' or not part[j].isspace():
+                return i, j
+    return None
+
+
+def _rstrip_parts(parts, start, chars):
+    """Strip chars off the end of what has been output since start"""
+    while len(parts) > start:
+        stripped = parts[-1].rstrip(chars)
+        if stripped:
+            parts[-1] = stripped
+            break
+        parts.pop()
+
+
+_RENDERERS = {
+    LITERAL: _render_literal,
+    VARIABLE: _render_variable,
+    NO_ESCAPE: _render_no_escape,
+    SECTION: _render_section,
+    INVERTED: _render_inverted,
+    END: _render_end,
+    PARTIAL: _render_partial,
+    SET_DELIMITER: _render_set_delimiter,
+    PARENT: _render_parent,
+    BLOCK: _render_block,
+}
+
+
 #
 # The main rendering function
 #
-g_token_cache = {}
 
 
 def render(template='', data={}, partials_path='.', partials_ext='mustache',
            partials_dict={}, padding='', def_ldel='{{', def_rdel='}}',
-           scopes=None, warn=False, keep=False):
+           scopes=None, warn=False, keep=False, max_depth=MAX_DEPTH,
+           workers=None, parallel_threshold=PARALLEL_THRESHOLD,
+           max_output_bytes=None, max_iterations=None, deadline=None,
+           minify=None, out=None):
     """Render a mustache template.
 
     Renders a mustache template with a data scope and partial capability.
@@ -149,6 +1356,7 @@ def render(template='', data={}, partials_path='.', partials_ext='mustache',
     Arguments:
 
     template      -- A file-like object or a string containing the template
+                     (or a Template)
 
     data          -- A python dictionary with your data scope
 
@@ -162,6 +1370,8 @@ def render(template='', data={}, partials_path='.', partials_ext='mustache',
     partials_dict -- A python dictionary which will be search for partials
                      before the filesystem is. {'include': 'foo'} is the same
                      as a file called include.mustache
+                     (The partials can be Templates, and a Loader works
+                     here too)
                      (defaults to {})
 
     padding       -- This is for padding partials, and shouldn't be used
@@ -179,205 +1389,210 @@ def render(template='', data={}, partials_path='.', partials_ext='mustache',
 
     keep          -- Keep unreplaced tags when a template substitution isn't found in the data
 
+    max_depth     -- How deep list sections and partials can be nested
+                     before a RecursionError is raised, None for no limit
+                     (defaults to 1000)
+
+    workers       -- How many processes to render long list sections with,
+                     None renders them in this process (defaults to None)
+                     The processes are forked, so where there's no fork
+                     lists are always rendered in this process
+
+    parallel_threshold -- How many items a list section needs to have to
+                          be rendered by the processes (defaults to 10000)
+
+    max_output_bytes -- How long the output can get, in bytes (of utf-8),
+                        None for no limit
+
+    max_iterations   -- How many list items and partials can be rendered,
+                        None for no limit
+
+    deadline         -- How many seconds the render can take, None for
+                        no limit
+
+                        The limits are checked as list items and partials
+                        start, and a RenderLimitError is raised when one
+                        is exceeded (defaults to None)
+
+    minify        -- Minify the text of the template (and its partials) for
+                     'html' or 'json' output, leaving the data as it is
+                     (defaults to None)
+
+    out           -- A file-like object to write the output to as it's
+                     rendered, rather than keeping it all to return
+                     (a CompressedWriter compresses it as it goes)
+                     (defaults to None)
+
 
     Returns:
 
-    A string containing the rendered template.
+    A string containing the rendered template (None if it went to out).
     """
 
-    # If the template is a seqeuence but not derived from a string
-    if isinstance(template, Sequence) and \
-            not isinstance(template, string_type):
-        # Then we don't need to tokenize it
-        # But it does need to be a generator
-        tokens = (token for token in template)
+    started = _timer()
+
+    # File-like templates are rendered as they're tokenized
+    # (unless they're minified, which needs all of their text)
+    streamed = minify is None and not isinstance(template, string_type) \
+        and not isinstance(template, Sequence)
+    if streamed:
+        program = None
+    else:
+        program = compile_template(template, def_ldel, def_rdel, minify)
+
+    # Templates that are only text and variables don't need a state
+    # (unless there's more to the render than the data)
+    if program is not None and program.flat is not None and \
+            scopes is None and not padding and \
+            max_output_bytes is None and max_iterations is None and \
+            deadline is None:
+        output = _render_flat(program.flat, data, warn, keep,
+                              def_ldel, def_rdel)
+        return _finish(output, out, started)
+
+    # Turn the scopes into a stack, with the innermost scope last
+    if scopes is None:
+        scopes = [data]
     else:
-        if template in g_token_cache:
-            tokens = (token for token in g_token_cache[template])
+        scopes = scopes[::-1]
+
+    state = _State(scopes, padding, partials_path, partials_ext,
+                   partials_dict, def_ldel, def_rdel, warn, keep, max_depth)
+    state.minify = minify
+    if program is not None and program.inherits:
+        program = _inherit(program, state)
+    state.out = out
+    state.workers = workers
+    state.parallel_threshold = parallel_threshold
+    if max_output_bytes is not None or max_iterations is not None or \
+            deadline is not None:
+        state.limits = _Limits(max_output_bytes, max_iterations, deadline)
+
+    # If the current scope is falsy and not the only scope
+    # then there's nothing to render
+    if scopes[-1] or len(scopes) == 1:
+        # Run through the tokens
+        if streamed:
+            _render_stream(state, template)
         else:
-            # Otherwise make a generator
-            tokens = tokenize(template, def_ldel, def_rdel)
+            _render_tokens(state, program, 0, len(program))
 
-    output = unicode('', 'utf-8')
+        # (The output since the last list item or partial counts too)
+        if state.limits is not None:
+            state.limits.check(state)
 
-    if scopes is None:
-        scopes = [data]
+    return _finish(_join(state.parts), out, started)
 
-    # Run through the tokens
-    for tag, key in tokens:
-        # Set the current scope
-        current_scope = scopes[0]
-
-        # If we're an end tag
-        if tag == 'end':
-            # Pop out of the latest scope
-            del scopes[0]
-
-        # If the current scope is falsy and not the only scope
-        elif not current_scope and len(scopes) != 1:
-            if tag in ['section', 'inverted section']:
-                # Set the most recent scope to a falsy value
-                # (I heard False is a good one)
-                scopes.insert(0, False)
-
-        # If we're a literal tag
-        elif tag == 'literal':
-            # Add padding to the key and add it to the output
-            if not isinstance(key, unicode_type):  # python 2
-                key = unicode(key, 'utf-8')
-            output += key.replace('\n', '\n' + padding)
-
-        # If we're a variable tag
-        elif tag == 'variable':
-            # Add the html escaped key to the output
-            thing = _get_key(key, scopes, warn=warn, keep=keep, def_ldel=def_ldel, def_rdel=def_rdel)
-            if thing is True and key == '.':
-                # if we've coerced into a boolean by accident
-                # (inverted tags do this)
-                # then get the un-coerced object (next in the stack)
-                thing = scopes[1]
-            if not isinstance(thing, unicode_type):
-                thing = unicode(str(thing), 'utf-8')
-            output += _html_escape(thing)
-
-        # If we're a no html escape tag
-        elif tag == 'no escape':
-            # Just lookup the key and add it
-            thing = _get_key(key, scopes, warn=warn, keep=keep, def_ldel=def_ldel, def_rdel=def_rdel)
-            if not isinstance(thing, unicode_type):
-                thing = unicode(str(thing), 'utf-8')
-            output += thing
-
-        # If we're a section tag
-        elif tag == 'section':
-            # Get the sections scope
-            scope = _get_key(key, scopes, warn=warn, keep=keep, def_ldel=def_ldel, def_rdel=def_rdel)
-
-            # If the scope is a callable (as described in
-            # https://mustache.github.io/mustache.5.html)
-            if isinstance(scope, Callable):
-
-                # Generate template text from tags
-                text = unicode('', 'utf-8')
-                tags = []
-                for tag in tokens:
-                    if tag == ('end', key):
-                        break
-
-                    tags.append(tag)
-                    tag_type, tag_key = tag
-                    if tag_type == 'literal':
-                        text += tag_key
-                    elif tag_type == 'no escape':
-                        text += "%s& %s %s" % (def_ldel, tag_key, def_rdel)
-                    else:
-                        text += "%s%s %s%s" % (def_ldel, {
-                                'commment': '!',
-                                'section': '#',
-                                'inverted section': '^',
-                                'end': '/',
-                                'partial': '>',
-                                'set delimiter': '=',
-                                'no escape': '&',
-                                'variable': ''
-                            }[tag_type], tag_key, def_rdel)
-
-                g_token_cache[text] = tags
-
-                rend = scope(text, lambda template, data=None: render(template,
-                             data={},
-                             partials_path=partials_path,
-                             partials_ext=partials_ext,
-                             partials_dict=partials_dict,
-                             padding=padding,
-                             def_ldel=def_ldel, def_rdel=def_rdel,
-                             scopes=data and [data]+scopes or scopes,
-                             warn=warn, keep=keep))
-
-                if python3:
-                    output += rend
-                else:  # python 2
-                    output += rend.decode('utf-8')
-
-            # If the scope is a sequence, an iterator or generator but not
-            # derived from a string
-            elif isinstance(scope, (Sequence, Iterator)) and \
-                    not isinstance(scope, string_type):
-                # Then we need to do some looping
-
-                # Gather up all the tags inside the section
-                # (And don't be tricked by nested end tags with the same key)
-                # TODO: This feels like it still has edge cases, no?
-                tags = []
-                tags_with_same_key = 0
-                for tag in tokens:
-                    if tag == ('section', key):
-                        tags_with_same_key += 1
-                    if tag == ('end', key):
-                        tags_with_same_key -= 1
-                        if tags_with_same_key < 0:
-                            break
-                    tags.append(tag)
-
-                # For every item in the scope
-                for thing in scope:
-                    # Append it as the most recent scope and render
-                    new_scope = [thing] + scopes
-                    rend = render(template=tags, scopes=new_scope,
-                                  padding=padding,
-                                  partials_path=partials_path,
-                                  partials_ext=partials_ext,
-                                  partials_dict=partials_dict,
-                                  def_ldel=def_ldel, def_rdel=def_rdel,
-                                  warn=warn, keep=keep)
-
-                    if python3:
-                        output += rend
-                    else:  # python 2
-                        output += rend.decode('utf-8')
 
-            else:
-                # Otherwise we're just a scope section
-                scopes.insert(0, scope)
-
-        # If we're an inverted section
-        elif tag == 'inverted section':
-            # Add the flipped scope to the scopes
-            scope = _get_key(key, scopes, warn=warn, keep=keep, def_ldel=def_ldel, def_rdel=def_rdel)
-            scopes.insert(0, not scope)
-
-        # If we're a partial
-        elif tag == 'partial':
-            # Load the partial
-            partial = _get_partial(key, partials_dict,
-                                   partials_path, partials_ext)
-
-            # Find what to pad the partial with
-            left = output.rpartition('\n')[2]
-            part_padding = padding
-            if left.isspace():
-                part_padding += left
-
-            # Render the partial
-            part_out = render(template=partial, partials_path=partials_path,
-                              partials_ext=partials_ext,
-                              partials_dict=partials_dict,
-                              def_ldel=def_ldel, def_rdel=def_rdel,
-                              padding=part_padding, scopes=scopes,
-                              warn=warn, keep=keep)
-
-            # If the partial was indented
-            if left.isspace():
-                # then remove the spaces from the end
-                part_out = part_out.rstrip(' \t')
+def _finish(output, out, started):
+    """Count a render, and return its output (or write it to out)"""
+    record_render(_timer() - started, len(output))
 
-            # Add the partials output to the ouput
-            if python3:
-                output += part_out
-            else:  # python 2
-                output += part_out.decode('utf-8')
+    if out is not None:
+        if output:
+            out.write(output if python3 else output.encode('utf-8'))
+        return None
 
     if python3:
         return output
     else:  # python 2
         return output.encode('utf-8')
+
+
+class _PrefixDone(Exception):
+    """There's enough output for the prefix, stop rendering"""
+
+
+def _counting(renderers, limit):
+    """Wrap the tag renderers so they stop the render once there's enough"""
+    size = [0]
+
+    def counting(renderer):
+        def render(state, program, index):
+            parts = state.parts
+            before = len(parts)
+            index = renderer(state, program, index)
+
+            # (Only what was added is counted, so the count only grows)
+            for part in parts[before:]:
+                size[0] += len(part)
+            if size[0] > limit:
+                # (but something may have been stripped since, and spaces
+                # at the end of the line may be stripped yet)
+                size[0] = len(_join(parts).rstrip(' \t'))
+                if size[0] > limit:
+                    raise _PrefixDone()
+            return index
+
+        return render
+
+    return dict((op, counting(renderer))
+                for op, renderer in renderers.items())
+
+
+def render_prefix(template='', data={}, limit=200, partials_path='.',
+                  partials_ext='mustache', partials_dict={}, def_ldel='{{',
+                  def_rdel='}}', warn=False, keep=False, max_depth=MAX_DEPTH,
+                  minify=None):
+    """Render the start of a mustache template
+
+    The render stops as soon as there's more than limit characters of
+    output, so only the start of the template is rendered (for previews
+    and snippets, say). Templates that haven't been compiled already are
+    only tokenized as far as the render gets, too.
+
+
+    Arguments:
+
+    template -- A file-like object or a string containing the template
+                (or a Template)
+
+    data     -- A python dictionary with your data scope
+
+    limit    -- How many characters of the output to render
+                (defaults to 200)
+
+    The rest are the same as render's.
+
+
+    Returns:
+
+    A tuple of the rendered text (only its first limit characters, if
+    it's longer) and whether it was cut short.
+    """
+    started = _timer()
+
+    # Templates that aren't compiled already are rendered as they're
+    # tokenized, so tokenizing stops with the render
+    # (unless they're minified, which needs all of their text)
+    if isinstance(template, string_type):
+        streamed = (template, def_ldel, def_rdel,
+                    minify) not in _template_cache
+    else:
+        streamed = not isinstance(template, Sequence)
+    streamed = streamed and minify is None
+
+    state = _State([data], '', partials_path, partials_ext, partials_dict,
+                   def_ldel, def_rdel, warn, keep, max_depth)
+    state.minify = minify
+    if not streamed:
+        program = compile_template(template, def_ldel, def_rdel, minify)
+        if program.inherits:
+            program = _inherit(program, state)
+    state.renderers = _counting(_RENDERERS, limit)
+
+    truncated = False
+    try:
+        if streamed:
+            _render_stream(state, template)
+        else:
+            _render_tokens(state, program, 0, len(program))
+    except _PrefixDone:
+        truncated = True
+
+    output = _join(state.parts)
+    if len(output) > limit:
+        output = output[:limit]
+        truncated = True
+
+    return _finish(output, None, started), truncated
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import stat as stat_module
+import sys
+
+try:
+    import socketserver
+except ImportError:  # python 2
+    import SocketServer as socketserver
+
+try:
+    from .renderer import render
+    from .watch import _stat, _compile_file
+except (ValueError, SystemError):  # python 2
+    from renderer import render
+    from watch import _stat, _compile_file
+
+
+# What a request can ask for, and what it gets if it doesn't
+DEFAULTS = {
+    'template': None,
+    'data': None,
+    'yaml_loader': 'SafeLoader',
+    'partials_path': '.',
+    'partials_ext': 'mustache',
+    'def_ldel': '{{',
+    'def_rdel': '}}',
+    'warn': False,
+    'minify': None,
+}
+
+
+class _Templates(object):
+    """Compiled template files, compiled again when they change"""
+
+    def __init__(self):
+        # (file, def_ldel, def_rdel) -> (stat, compiled template)
+        self._compiled = {}
+
+    def get(self, file_path, def_ldel, def_rdel):
+        """Get a compiled template, raises KeyError if there isn't one"""
+        key = (file_path, def_ldel, def_rdel)
+        stat = _stat(file_path)
+        try:
+            cached_stat, template = self._compiled[key]
+            if cached_stat == stat:
+                return template
+        except KeyError:
+            pass
+
+        if stat is None:
+            self._compiled.pop(key, None)
+            raise KeyError(file_path)
+
+        template = _compile_file(file_path, def_ldel, def_rdel)
+        self._compiled[key] = (stat, template)
+        return template
+
+
+class _Partials(object):
+    """The partials in a directory, as a partials_dict"""
+
+    def __init__(self, templates, request):
+        self.templates = templates
+        self.request = request
+
+    def __getitem__(self, name):
+        request = self.request
+        if not request['partials_path']:
+            raise KeyError(name)
+
+        ext = request['partials_ext']
+        path_ext = ('.' + ext if ext else '')
+        file_path = os.path.join(request['partials_path'], name + path_ext)
+        return self.templates.get(file_path, request['def_ldel'],
+                                  request['def_rdel'])
+
+
+class Server(object):
+    """Render template files for whoever asks, keeping everything in memory
+
+    Requests and responses are json objects, one per line. A request
+    names a template file, and optionally a data file and any of the
+    options of the command line (see DEFAULTS):
+
+    {"template": "/abs/page.mustache", "data": "/abs/data.json"}
+
+    and gets back either {"output": "..."} or {"error": "..."}.
+
+    Template and partial files are compiled once, and again only when
+    they change (as are data files). Relative paths are relative to the
+    server's directory, so clients should send absolute ones.
+    """
+
+    def __init__(self):
+        self.templates = _Templates()
+
+    def handle(self, request):
+        """Render one request, returns the response"""
+        try:
+            from .main import _load_data_file
+        except (ValueError, SystemError):  # python 2
+            from main import _load_data_file
+
+        try:
+            unknown = set(request) - set(DEFAULTS)
+            if unknown:
+                raise ValueError('Unknown options: {0}'
+                                 .format(', '.join(sorted(unknown))))
+            options = dict(DEFAULTS)
+            options.update(request)
+
+            try:
+                template = self.templates.get(options['template'],
+                                              options['def_ldel'],
+                                              options['def_rdel'])
+            except KeyError:
+                raise IOError('The file {0} does not exist!'
+                              .format(options['template']))
+
+            data = {}
+            if options['data']:
+                data = _load_data_file(options['data'],
+                                       options['yaml_loader'])
+
+            output = render(template, data,
+                            partials_dict=_Partials(self.templates, options),
+                            partials_path=None,
+                            def_ldel=options['def_ldel'],
+                            def_rdel=options['def_rdel'],
+                            warn=options['warn'],
+                            minify=options['minify'])
+        except SyntaxError as error:
+            return {'error': 'syntax error\n' + error.args[0]}
+        except (IOError, ValueError, TypeError, RuntimeError) as error:
+            # (Broken json or yaml data is a ValueError, and partials that
+            # include themselves are a RuntimeError)
+            return {'error': str(error)}
+
+        if not isinstance(output, type(u'')):  # python 2
+            output = output.decode('utf-8')
+        return {'output': output}
+
+    def handle_lines(self, lines, write):
+        """Answer every request read from lines, giving responses to write"""
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('A request must be a json object')
+            except ValueError as error:
+                response = {'error': str(error)}
+            else:
+                response = self.handle(request)
+
+            write(json.dumps(response) + '\n')
+
+    def serve(self, socket_path):
+        """Listen on a unix socket (or stdin and stdout for '-')"""
+        if socket_path == '-':
+            def write(text):
+                sys.stdout.write(text)
+                sys.stdout.flush()
+
+            return self.handle_lines(iter(sys.stdin.readline, ''), write)
+
+        # Replace a socket left behind by a server that's gone
+        try:
+            if stat_module.S_ISSOCK(os.stat(socket_path).st_mode):
+                os.unlink(socket_path)
+        except OSError:
+            pass
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                def write(text):
+                    self.wfile.write(text.encode('utf-8'))
+
+                server.handle_lines(iter(self.rfile.readline, b''), write)
+
+        class UnixServer(socketserver.ThreadingMixIn,
+                         socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        listener = UnixServer(socket_path, Handler)
+        try:
+            listener.serve_forever()
+        finally:
+            listener.server_close()
+            os.unlink(socket_path)
+
+
+def request(socket_path, **options):
+    """Ask a server to render a template
+
+    The options are those of a request (see Server), and relative paths
+    in them are made absolute.
+
+    Returns the response.
+    """
+    for name in ('template', 'data', 'partials_path'):
+        if options.get(name):
+            options[name] = os.path.abspath(options[name])
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(options).encode('utf-8') + b'\n')
+        responses = client.makefile('rb')
+        try:
+            return json.loads(responses.readline().decode('utf-8'))
+        finally:
+            responses.close()
+    finally:
+        client.close()
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+
+try:
+    _clock = time.perf_counter
+except AttributeError:  # python 2
+    _clock = time.time
+
+
+# The upper bounds of the render latency histogram, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Counters(object):
+    """The counts of one thread
+
+    Every thread counts on its own (so counting never waits on a lock,
+    or loses counts to another thread), and they're added up when
+    someone asks.
+    """
+
+    __slots__ = ('thread', 'nested', 'renders', 'render_seconds',
+                 'render_buckets', 'tokens', 'tokenize_seconds',
+                 'template_cache_hits', 'template_cache_misses',
+                 'partial_cache_hits', 'partial_cache_misses',
+                 'output_bytes', 'lambda_calls', 'missing_keys')
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        # How many lambdas are rendering (their output is counted by the
+        # render they're in)
+        self.nested = 0
+        self.renders = 0
+        self.render_seconds = 0.0
+        self.render_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.tokens = 0
+        self.tokenize_seconds = 0.0
+        self.template_cache_hits = 0
+        self.template_cache_misses = 0
+        self.partial_cache_hits = 0
+        self.partial_cache_misses = 0
+        self.output_bytes = 0
+        self.lambda_calls = 0
+        self.missing_keys = 0
+
+    def add(self, other, sign=1):
+        for name in self.__slots__[2:]:
+            if name == 'render_buckets':
+                for i, count in enumerate(other.render_buckets):
+                    self.render_buckets[i] += sign * count
+            else:
+                setattr(self, name, getattr(self, name) +
+                        sign * getattr(other, name))
+
+
+_local = threading.local()
+_lock = threading.Lock()
+# The counters of every thread that has counted something
+_threads = []
+# And what the threads that are gone counted
+_retired = _Counters()
+# What had been counted when the counts were last reset
+_baseline = _Counters()
+
+
+def counters():
+    """Get the counters of the current thread"""
+    try:
+        return _local.counters
+    except AttributeError:
+        mine = _local.counters = _Counters(threading.current_thread())
+        with _lock:
+            _threads.append(mine)
+        return mine
+
+
+def record_render(seconds, output_bytes):
+    """Count a render that took seconds, and made output_bytes"""
+    mine = counters()
+    mine.renders += 1
+    mine.render_seconds += seconds
+    mine.render_buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    if not mine.nested:
+        mine.output_bytes += output_bytes
+
+
+def _total():
+    """Add up the counts of every thread (since the last reset)"""
+    total = _Counters()
+    with _lock:
+        total.add(_baseline, -1)
+        # (Folding the threads that are gone into one)
+        for mine in _threads[:]:
+            if not mine.thread.is_alive():
+                _retired.add(mine)
+                _threads.remove(mine)
+        total.add(_retired)
+        for mine in _threads:
+            total.add(mine)
+    return total
+
+
+def _rate(hits, misses):
+    return hits / float(hits + misses) if hits + misses else None
+
+
+def metrics(reset=False):
+    """Get a snapshot of what chevron has done in this process
+
+    Arguments:
+
+    reset -- Start counting again from zero after the snapshot
+             (defaults to False)
+
+
+    Returns:
+
+    A dictionary of:
+
+    renders          -- How many renders finished (renders by lambdas
+                        count too)
+    render_seconds   -- The latency of those renders: a dictionary of
+                        their 'count', their 'sum' and the 'buckets', a
+                        list of (upper bound, renders that took at most
+                        that long)
+    tokens           -- How many tokens templates were compiled into
+    tokenize_seconds -- How long compiling the templates took
+    template_cache   -- The 'hits', 'misses' and 'hit_rate' (None before
+                        any lookups) of the cache of compiled templates
+    partial_cache    -- The same, for the lookups of partials
+    output_bytes     -- How much output the renders made, in characters
+                        (which is bytes, for ascii)
+    lambda_calls     -- How many times lambdas were called
+    missing_keys     -- How many keys weren't found
+    """
+    total = _total()
+    if reset:
+        _reset(total)
+
+    buckets = []
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS + (float('inf'),),
+                            total.render_buckets):
+        seen += count
+        buckets.append((bound, seen))
+
+    return {
+        'renders': total.renders,
+        'render_seconds': {
+            'count': total.renders,
+            'sum': total.render_seconds,
+            'buckets': buckets,
+        },
+        'tokens': total.tokens,
+        'tokenize_seconds': total.tokenize_seconds,
+        'template_cache': {
+            'hits': total.template_cache_hits,
+            'misses': total.template_cache_misses,
+            'hit_rate': _rate(total.template_cache_hits,
+                              total.template_cache_misses),
+        },
+        'partial_cache': {
+            'hits': total.partial_cache_hits,
+            'misses': total.partial_cache_misses,
+            'hit_rate': _rate(total.partial_cache_hits,
+                              total.partial_cache_misses),
+        },
+        'output_bytes': total.output_bytes,
+        'lambda_calls': total.lambda_calls,
+        'missing_keys': total.missing_keys,
+    }
+
+
+def reset_metrics():
+    """Start counting again from zero"""
+    _reset(_total())
+
+
+def _reset(total):
+    # (Each thread's counters are its own, so rather than changing them
+    # under it, what they've counted so far is taken off from now on)
+    with _lock:
+        _baseline.add(total)
+
+
+def prometheus(snapshot=None):
+    """Format a snapshot of the metrics as Prometheus text
+
+    Arguments:
+
+    snapshot -- What metrics() returned (defaults to a new snapshot)
+
+
+    Returns:
+
+    The text, in the Prometheus exposition format
+    """
+    if snapshot is None:
+        snapshot = metrics()
+
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append('# HELP chevron_{0} {1}'.format(name, help_text))
+        lines.append('# TYPE chevron_{0} {1}'.format(name, kind))
+        for suffix, labels, value in samples:
+            lines.append('chevron_{0}{1}{2} {3}'.format(
+                name, suffix, labels, repr(float(value))
+                if isinstance(value, float) else value))
+
+    metric('renders_total', 'counter', 'Renders that finished.',
+           [('', '', snapshot['renders'])])
+
+    latency = snapshot['render_seconds']
+    samples = [('_bucket', '{{le="{0}"}}'.format(
+        '+Inf' if bound == float('inf') else repr(bound)), count)
+        for bound, count in latency['buckets']]
+    samples.append(('_sum', '', latency['sum']))
+    samples.append(('_count', '', latency['count']))
+    metric('render_seconds', 'histogram', 'How long renders took.',
+           samples)
+
+    metric('tokens_total', 'counter',
+           'Tokens that templates were compiled into.',
+           [('', '', snapshot['tokens'])])
+    metric('tokenize_seconds_total', 'counter',
+           'Time spent compiling templates.',
+           [('', '', snapshot['tokenize_seconds'])])
+
+    for cache in ('template_cache', 'partial_cache'):
+        metric(cache + '_hits_total', 'counter',
+               'Lookups in the {0} that hit.'.format(cache.replace('_', ' ')),
+               [('', '', snapshot[cache]['hits'])])
+        metric(cache + '_misses_total', 'counter',
+               'Lookups in the {0} that missed.'
+               .format(cache.replace('_', ' ')),
+               [('', '', snapshot[cache]['misses'])])
+
+    metric('output_bytes_total', 'counter',
+           'Output made, in characters.',
+           [('', '', snapshot['output_bytes'])])
+    metric('lambda_calls_total', 'counter', 'Lambdas called.',
+           [('', '', snapshot['lambda_calls'])])
+    metric('missing_keys_total', 'counter', "Keys that weren't found.",
+           [('', '', snapshot['missing_keys'])])
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(file_path, snapshot=None):
+    """Write the metrics to a file, in the Prometheus text format
+
+    The file is replaced in one go, so it can be read by node_exporter's
+    textfile collector (or anything else) at any time.
+
+
+    Arguments:
+
+    file_path -- Where to write them (a .prom file, for node_exporter)
+
+    snapshot  -- What metrics() returned (defaults to a new snapshot)
+    """
+    text = prometheus(snapshot)
+    directory = os.path.dirname(os.path.abspath(file_path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.')
+    try:
+        with os.fdopen(handle, 'w') as prom:
+            prom.write(text)
+        os.rename(temp_path, file_path)
+    except (IOError, OSError):
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def footprint(templates=None):
+    """Measure how much memory a set of compiled templates takes
+
+    Everything the templates have is counted once, however many of them
+    share it (strings that are shared are counted in shared_bytes too).
+
+
+    Arguments:
+
+    templates -- The Templates (defaults to the ones compiled from
+                 strings, in render's cache)
+
+
+    Returns:
+
+    A dictionary of:
+
+    templates    -- How many templates there are
+    tokens       -- How many tokens they have
+    bytes        -- The memory they take, all told
+    string_bytes -- How much of that is strings (keys and literals)
+    strings      -- How many strings they have (each one once)
+    shared_bytes -- How much memory sharing strings saves
+    """
+    if templates is None:
+        try:
+            from .renderer import _template_cache
+        except (ValueError, SystemError):  # python 2
+            from renderer import _template_cache
+        templates = list(_template_cache.values())
+
+    seen = {}
+    totals = {'templates': 0, 'tokens': 0, 'bytes': 0, 'string_bytes': 0,
+              'strings': 0, 'shared_bytes': 0}
+
+    def measure(thing):
+        if thing is None:
+            return
+        size = sys.getsizeof(thing)
+        if isinstance(thing, (str, type(u''))):
+            if id(thing) in seen:
+                totals['shared_bytes'] += size
+                return
+            seen[id(thing)] = thing
+            totals['strings'] += 1
+            totals['string_bytes'] += size
+            totals['bytes'] += size
+            return
+
+        if id(thing) in seen:
+            return
+        seen[id(thing)] = thing
+        totals['bytes'] += size
+        if isinstance(thing, (tuple, list)):
+            for item in thing:
+                measure(item)
+
+    def measure_template(program):
+        if id(program) in seen:
+            return False
+        measure(program)
+        for token in program:
+            for name in token.__slots__:
+                measure(getattr(token, name))
+        measure(program.flat)
+        # (The template it was expanded from is part of it)
+        if program.source is not None:
+            measure_template(program.source)
+        return True
+
+    for program in templates:
+        if measure_template(program):
+            totals['templates'] += 1
+            totals['tokens'] += len(program)
+    return totals
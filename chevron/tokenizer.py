@@ -1,34 +1,252 @@
-# Globals
-_CURRENT_LINE = 1
-_LAST_TAG_LINE = None
+import codecs
+import sys
+
+if sys.version_info[0] == 3:
+    string_type = str
+    binary_type = bytes
+else:  # python 2
+    string_type = basestring  # noqa: F821 (This is defined in python2)
+    binary_type = None
+
+# How much of a file-like template is read at a time
+CHUNK_SIZE = 64 * 1024
 
 
 class ChevronError(SyntaxError):
     pass
 
+#
+# Tokens
+#
+
+
+# The tag types, in the order of their opcodes
+TAG_TYPES = ('literal', 'variable', 'no escape', 'section',
+             'inverted section', 'end', 'partial', 'set delimiter',
+             'parent', 'block')
+
+(LITERAL, VARIABLE, NO_ESCAPE, SECTION,
+ INVERTED, END, PARTIAL, SET_DELIMITER,
+ PARENT, BLOCK) = range(len(TAG_TYPES))
+
+OPCODES = dict((tag_type, op) for op, tag_type in enumerate(TAG_TYPES))
+
+# The tags that look something up in the data
+_KEYED = frozenset([VARIABLE, NO_ESCAPE, SECTION, INVERTED])
+
+
+class Token(object):
+    """A mustache tag
+
+    Tokens unpack, index and compare like the (tag_type, tag_key) tuples
+    that tokenize used to yield, but the tag type is stored as an
+    integer opcode and the token carries what the renderer would
+    otherwise have to work out every time it sees the tag.
+
+    op    -- The opcode of the tag type (see TAG_TYPES)
+    key   -- The key, or in the case of a literal the literal itself
+    path  -- The key split on its dots (None if the key isn't looked up,
+             or is the implicit iterator)
+    end   -- For sections, how many tokens ahead the matching end tag is
+    start -- Where the tag starts in the template (None if unknown)
+    stop  -- Where the tag stops in the template (None if unknown)
+    indent -- For standalone parent and block tags, the whitespace that
+              was before them on their line (None for other tags)
+    """
+
+    __slots__ = ('op', 'key', 'path', 'end', 'start', 'stop', 'indent')
+
+    def __init__(self, op, key, start=None, stop=None):
+        self.op = op
+        self.key = key
+        if op in _KEYED and key != '.':
+            self.path = tuple(key.split('.'))
+        else:
+            self.path = None
+        self.end = 0
+        self.start = start
+        self.stop = stop
+        self.indent = None
+
+    @property
+    def tag_type(self):
+        return TAG_TYPES[self.op]
+
+    def __iter__(self):
+        yield TAG_TYPES[self.op]
+        yield self.key
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, index):
+        return (TAG_TYPES[self.op], self.key)[index]
+
+    def __eq__(self, other):
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return 'Token({0!r}, {1!r})'.format(TAG_TYPES[self.op], self.key)
+
+#
+# Template reading
+#
+
+
+def _read_chunks(template, chunk_size):
+    """Yield the text of a template a chunk at a time"""
+
+    # Strings are already in memory, so don't copy them into chunks
+    if isinstance(template, string_type):
+        yield template
+        return
+
+    decoder = None
+    while True:
+        chunk = template.read(chunk_size)
+        if not chunk:
+            break
+
+        # Binary files and mmaps give us bytes, which we decode as we go
+        # (A multi-byte character may be split across two chunks)
+        if binary_type is not None and isinstance(chunk, binary_type):
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder('utf-8')()
+            chunk = decoder.decode(chunk)
+
+        yield chunk
+
+    if decoder is not None:
+        tail = decoder.decode(b'', True)
+        if tail:
+            yield tail
+
+
+class _Reader(object):
+    """A window over the template text
+
+    Only the part of the template that hasn't been tokenized yet is kept,
+    and it is refilled from the template a chunk at a time when needed.
+    """
+
+    __slots__ = ('buf', 'pos', 'offset', 'eof', 'chunk_size', 'line',
+                 '_chunks')
+
+    def __init__(self, template, chunk_size):
+        self.buf = ''
+        self.pos = 0
+        # Where the buffer starts in the template
+        self.offset = 0
+        self.eof = False
+        # The line we're on, for errors (only newlines in literals count)
+        self.line = 1
+        self.chunk_size = chunk_size
+        self._chunks = _read_chunks(template, chunk_size)
+
+    def more(self):
+        """Read the next chunk, returns False if there is nothing left"""
+        for chunk in self._chunks:
+            if chunk:
+                self.buf = self.buf[self.pos:] + chunk
+                self.offset += self.pos
+                self.pos = 0
+                return True
+
+        self.eof = True
+        return False
+
+    def find(self, needle):
+        """Find needle after the current position, reading as needed"""
+        start = self.pos
+        while True:
+            index = self.buf.find(needle, start)
+            if index != -1 or self.eof:
+                return index
+
+            # Don't rescan what we've already looked at
+            # (but the needle could have been cut in half by the chunk)
+            scanned = len(self.buf) - self.pos - len(needle) + 1
+            if not self.more():
+                return -1
+            start = max(scanned, 0)
+
+    def tell(self):
+        """Get the current position in the template"""
+        return self.offset + self.pos
+
+    def at_end(self):
+        """Check if the whole template has been read"""
+        return self.pos >= len(self.buf) and not self.more()
+
+    def startswith(self, prefix):
+        """Check if the text at the current position starts with prefix"""
+        while len(self.buf) - self.pos < len(prefix) and self.more():
+            pass
+        return self.buf.startswith(prefix, self.pos)
+
 #
 # Helper functions
 #
 
 
-def grab_literal(template, l_del):
-    """Parse a literal from the template"""
+def grab_literal(reader, l_del):
+    """Parse a literal from the template
 
-    global _CURRENT_LINE
+    Returns the literal and whether a tag follows it. If the literal
+    would grow past the chunk size it is cut after its last newline,
+    in which case None is returned instead, and the rest of it will
+    come with the next call.
+    """
 
-    try:
+    start = reader.pos
+    while True:
         # Look for the next tag and move the template to it
-        literal, template = template.split(l_del, 1)
-        _CURRENT_LINE += literal.count('\n')
-        return (literal, template)
+        index = reader.buf.find(l_del, start)
+        if index != -1:
+            literal = reader.buf[reader.pos:index]
+            reader.pos = index + len(l_del)
+            tag_follows = True
+            break
+
+        # Don't let a long literal fill up the buffer,
+        # hand out the lines we already have instead
+        if len(reader.buf) - reader.pos > reader.chunk_size:
+            # (A delimiter might be cut in half at the end of the buffer)
+            newline = reader.buf.rfind('\n', reader.pos,
+                                       len(reader.buf) - len(l_del) + 1)
+            if newline != -1:
+                literal = reader.buf[reader.pos:newline + 1]
+                reader.pos = newline + 1
+                tag_follows = None
+                break
+
+        # There are no more tags in the template?
+        scanned = len(reader.buf) - reader.pos - len(l_del) + 1
+        if not reader.more():
+            # Then the rest of the template is a literal
+            literal = reader.buf[reader.pos:]
+            reader.pos = len(reader.buf)
+            tag_follows = False
+            break
+        start = max(scanned, 0)
 
-    # There are no more tags in the template?
-    except ValueError:
-        # Then the rest of the template is a literal
-        return (template, '')
+    reader.line += literal.count('\n')
+    return (literal, tag_follows)
 
 
-def l_sa_check(template, literal, is_standalone):
+def l_sa_check(literal, is_standalone):
     """Do a preliminary check to see if a tag could be a standalone"""
 
     # If there is a newline, or the previous tag was a standalone
@@ -44,46 +262,86 @@ def l_sa_check(template, literal, is_standalone):
             return False
 
 
-def r_sa_check(template, tag_type, is_standalone):
-    """Do a final checkto see if a tag could be a standalone"""
+def r_sa_check(reader, tag_type, is_standalone):
+    """Do a final checkto see if a tag could be a standalone
+
+    Returns where the standalone's line ends,
+    or None if the tag is not a standalone.
+    """
 
     # Check right side if we might be a standalone
     if is_standalone and tag_type not in ['variable', 'no escape']:
-        on_newline = template.split('\n', 1)
-
-        # If the stuff to the right of us are spaces we're a standalone
-        if on_newline[0].isspace() or not on_newline[0]:
-            return True
-        else:
-            return False
+        start = reader.pos
+        while True:
+            newline = reader.buf.find('\n', start)
+            if newline == -1:
+                on_newline = reader.buf[reader.pos:]
+            else:
+                on_newline = reader.buf[reader.pos:newline]
+
+            # If the stuff to the right of us are spaces we're a standalone
+            if not (on_newline.isspace() or not on_newline):
+                return None
+            if newline != -1:
+                return newline
+
+            # We need to see the rest of the line to be sure
+            scanned = len(reader.buf) - reader.pos
+            if not reader.more():
+                return len(reader.buf)
+            start = scanned
 
     # If we're a tag can't be a standalone
     else:
-        return False
+        return None
 
 
-def parse_tag(template, l_del, r_del):
-    """Parse a tag from a template"""
-    global _CURRENT_LINE
-    global _LAST_TAG_LINE
+def _tags_follow(reader, l_del, r_del):
+    """Check if the rest of the line is only block, parent and end tags
+
+    Such a line is standalone as a whole (like {{$block}}{{/block}}),
+    so the first tag on it is too.
+    """
+    newline = reader.find('\n')
+    if newline == -1:
+        newline = len(reader.buf)
+    rest = reader.buf[reader.pos:newline]
+
+    while True:
+        rest = rest.lstrip()
+        if not rest:
+            return True
+        if not rest.startswith(l_del) or \
+                rest[len(l_del):len(l_del) + 1] not in ('$', '<', '/', '!'):
+            return False
+        end = rest.find(r_del, len(l_del))
+        if end == -1:
+            return False
+        rest = rest[end + len(r_del):]
 
+
+def parse_tag(reader, l_del, r_del):
+    """Parse a tag from a template"""
     tag_types = {
         '!': 'comment',
         '#': 'section',
         '^': 'inverted section',
         '/': 'end',
         '>': 'partial',
+        '<': 'parent',
+        '$': 'block',
         '=': 'set delimiter?',
         '{': 'no escape?',
         '&': 'no escape'
     }
 
     # Get the tag
-    try:
-        tag, template = template.split(r_del, 1)
-    except ValueError:
+    end = reader.find(r_del)
+    if end == -1:
         raise ChevronError('unclosed tag '
-                           'at line {0}'.format(_CURRENT_LINE))
+                           'at line {0}'.format(reader.line))
+    tag = reader.buf[reader.pos:end]
+    reader.pos = end + len(r_del)
 
     # Find the type meaning of the first character
     tag_type = tag_types.get(tag[0], 'variable')
@@ -104,91 +362,110 @@ def parse_tag(template, l_del, r_del):
         # Otherwise we should complain
         else:
             raise ChevronError('unclosed set delimiter tag\n'
-                               'at line {0}'.format(_CURRENT_LINE))
+                               'at line {0}'.format(reader.line))
 
     # If we might be a no html escape tag
     elif tag_type == 'no escape?':
         # And we have a third curly brace
         # (And are using curly braces as delimiters)
-        if l_del == '{{' and r_del == '}}' and template.startswith('}'):
+        if l_del == '{{' and r_del == '}}' and reader.startswith('}'):
             # Then we are a no html escape tag
-            template = template[1:]
+            reader.pos += 1
             tag_type = 'no escape'
 
     # Strip the whitespace off the key and return
-    return ((tag_type, tag.strip()), template)
+    return (tag_type, tag.strip())
 
 
 #
 # The main tokenizing function
 #
 
-def tokenize(template, def_ldel='{{', def_rdel='}}'):
+def tokenize(template, def_ldel='{{', def_rdel='}}', chunk_size=CHUNK_SIZE):
     """Tokenize a mustache template
 
     Tokenizes a mustache template in a generator fashion,
     using file-like objects. It also accepts a string containing
     the template.
 
+    File-like objects (including binary files and mmaps, which are
+    decoded as utf-8) are read a chunk at a time, so tokens are
+    produced while the template is read and the whole template
+    never has to be in memory at once.
+
 
     Arguments:
 
-    template -- a file-like object, or a string of a mustache template
+    template   -- a file-like object, or a string of a mustache template
+
+    def_ldel   -- The default left delimiter
+                  ("{{" by default, as in spec compliant mustache)
 
-    def_ldel -- The default left delimiter
-                ("{{" by default, as in spec compliant mustache)
+    def_rdel   -- The default right delimiter
+                  ("}}" by default, as in spec compliant mustache)
 
-    def_rdel -- The default right delimiter
-                ("}}" by default, as in spec compliant mustache)
+    chunk_size -- How much of a file-like template to read at a time
 
 
     Returns:
 
-    A generator of mustache tags in the form of a tuple
+    A generator of mustache tags as Tokens, which act like a tuple
 
     -- (tag_type, tag_key)
 
     Where tag_type is one of:
      * literal
+     * variable
      * section
      * inverted section
      * end
      * partial
      * no escape
+     * set delimiter
 
     And tag_key is either the key or in the case of a literal tag,
     the literal itself.
     """
 
-    global _CURRENT_LINE, _LAST_TAG_LINE
-    _CURRENT_LINE = 1
-    _LAST_TAG_LINE = None
-    # If the template is a file-like object then read it
-    try:
-        template = template.read()
-    except AttributeError:
-        pass
+    reader = _Reader(template, chunk_size)
+    # (Where the last section was opened, for errors)
+    last_tag_line = None
 
     is_standalone = True
     open_sections = []
+    # (And the type of each, to know which end tags close blocks)
+    open_types = []
     l_del = def_ldel
     r_del = def_rdel
 
-    while template:
-        literal, template = grab_literal(template, l_del)
+    while True:
+        literal_start = reader.tell()
+        literal, tag_follows = grab_literal(reader, l_del)
+
+        # If the literal was too long to keep in one piece
+        if tag_follows is None:
+            # Then yield what we have so far and keep going
+            # (It ends in a newline, so a tag after it could be a standalone)
+            yield Token(LITERAL, literal,
+                        literal_start, literal_start + len(literal))
+            is_standalone = True
+            continue
 
         # If the template is completed
-        if not template:
+        if not tag_follows or reader.at_end():
             # Then yield the literal and leave
-            yield ('literal', literal)
+            if literal != '':
+                yield Token(LITERAL, literal,
+                            literal_start, literal_start + len(literal))
             break
 
         # Do the first check to see if we could be a standalone
-        is_standalone = l_sa_check(template, literal, is_standalone)
+        is_standalone = l_sa_check(literal, is_standalone)
 
         # Parse the tag
-        tag, template = parse_tag(template, l_del, r_del)
-        tag_type, tag_key = tag
+        tag_start = reader.tell() - len(l_del)
+        tag_type, tag_key = parse_tag(reader, l_del, r_del)
+        tag_stop = reader.tell()
 
         # Special tag logic
 
@@ -198,11 +475,12 @@ def tokenize(template, def_ldel='{{', def_rdel='}}'):
             dels = tag_key.strip().split(' ')
             l_del, r_del = dels[0], dels[-1]
 
-        # If we are a section tag
-        elif tag_type in ['section', 'inverted section']:
+        # If we are a section tag (or a parent or a block, which end alike)
+        elif tag_type in ['section', 'inverted section', 'parent', 'block']:
             # Then open a new section
             open_sections.append(tag_key)
-            _LAST_TAG_LINE = _CURRENT_LINE
+            open_types.append(tag_type)
+            last_tag_line = reader.line
 
         # If we are an end tag
         elif tag_type == 'end':
@@ -210,40 +488,62 @@ def tokenize(template, def_ldel='{{', def_rdel='}}'):
             # is the same as us
             try:
                 last_section = open_sections.pop()
+                last_type = open_types.pop()
             except IndexError:
                 raise ChevronError('Trying to close tag "{0}"\n'
                                    'Looks like it was not opened.\n'
                                    'line {1}'
-                                   .format(tag_key, _CURRENT_LINE + 1))
+                                   .format(tag_key, reader.line + 1))
             if tag_key != last_section:
                 # Otherwise we need to complain
                 raise ChevronError('Trying to close tag "{0}"\n'
                                    'last open tag is "{1}"\n'
                                    'line {2}'
                                    .format(tag_key, last_section,
-                                           _CURRENT_LINE + 1))
+                                           reader.line + 1))
 
         # Do the second check to see if we're a standalone
-        is_standalone = r_sa_check(template, tag_type, is_standalone)
+        line_end = r_sa_check(reader, tag_type, is_standalone)
+
+        # A line of only parent and block tags is standalone as a whole
+        # (like {{$block}}{{/block}}), the last of them takes the newline
+        inline = line_end is None and is_standalone and \
+            (tag_type in ('parent', 'block') or
+             (tag_type == 'end' and last_type in ('parent', 'block'))) and \
+            _tags_follow(reader, l_del, r_del)
+        is_standalone = line_end is not None
 
         # Which if we are
-        if is_standalone:
+        indent = None
+        if is_standalone or inline:
             # Remove the stuff before the newline
-            template = template.split('\n', 1)[-1]
+            if is_standalone and line_end < len(reader.buf):
+                reader.pos = line_end + 1
+
+            # Parents and blocks remember their indentation
+            if tag_type in ('parent', 'block'):
+                indent = literal.rpartition('\n')[2]
+                literal = literal[:len(literal) - len(indent)]
 
             # Partials need to keep the spaces on their left
-            if tag_type != 'partial':
+            elif tag_type != 'partial':
                 # But other tags don't
                 literal = literal.rstrip(' ')
 
+            is_standalone = True
+
         # Start yielding
         # Ignore literals that are empty
         if literal != '':
-            yield ('literal', literal)
+            yield Token(LITERAL, literal,
+                        literal_start, literal_start + len(literal))
 
-        # Ignore comments and set delimiters
-        if tag_type not in ['comment', 'set delimiter?']:
-            yield (tag_type, tag_key)
+        # Ignore comments, and braces that were never closed
+        # (which we've never rendered anything for)
+        if tag_type not in ('comment', 'no escape?'):
+            token = Token(OPCODES[tag_type], tag_key, tag_start, tag_stop)
+            token.indent = indent
+            yield token
 
     # If there are any open sections when we're done
     if open_sections:
@@ -251,4 +551,4 @@ def tokenize(template, def_ldel='{{', def_rdel='}}'):
         raise ChevronError('Unexpected EOF\n'
                            'the tag "{0}" was never closed\n'
                            'was opened at line {1}'
-                           .format(open_sections[-1], _LAST_TAG_LINE))
+                           .format(open_sections[-1], last_tag_line))
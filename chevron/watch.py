@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import time
+
+try:
+    from .renderer import render, _compile_source
+except (ValueError, SystemError):  # python 2
+    from renderer import render, _compile_source
+
+
+def _common_directory(templates):
+    """Find the deepest directory that all the templates are in"""
+    directories = [os.path.dirname(os.path.abspath(template)).split(os.sep)
+                   for template in templates]
+    if not directories:
+        return os.getcwd()
+
+    common = directories[0]
+    for directory in directories[1:]:
+        for i, (mine, theirs) in enumerate(zip(common, directory)):
+            if mine != theirs:
+                common = common[:i]
+                break
+        else:
+            common = common[:len(directory)]
+    return os.sep.join(common) or os.sep
+
+
+def _stat(file_path):
+    """Get what we need to know if a file has changed (None if it's gone)"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size)
+
+
+def _compile_file(file_path, def_ldel, def_rdel):
+    with io.open(file_path, 'r', encoding='utf-8') as template_file:
+        return _compile_source(template_file.read(), def_ldel, def_rdel)
+
+
+class _Partials(object):
+    """The partials of a Watcher, remembering which ones get used"""
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+        self.used = None
+
+    def __getitem__(self, name):
+        if self.used is not None:
+            self.used.add(name)
+        return self.watcher.get_partial(name)
+
+
+class Watcher(object):
+    """Render templates to a directory, and keep them up to date
+
+    Every build checks the templates, the data file and the partials
+    that were used by the last render of each template for changes
+    (by their modification time and size), and renders only the
+    templates that are affected. Compiled templates and partials are
+    kept between builds.
+
+
+    Arguments:
+
+    templates     -- A list of template files
+
+    output_dir    -- The directory to render to. Each template is
+                     rendered to a file of the same name, without
+                     its last extension (in the same subdirectory,
+                     from the directory all the templates are in)
+
+    data          -- A data file (json or yaml)
+
+    yaml_loader   -- The yaml loader to load the data with
+
+    partials_path -- The directory where the partials are
+
+    partials_ext  -- The extension of the partials
+
+    The other keyword arguments are passed on to render.
+    """
+
+    def __init__(self, templates, output_dir, data=None,
+                 yaml_loader='SafeLoader', partials_path='.',
+                 partials_ext='mustache', **kwargs):
+        self.templates = list(templates)
+        self.output_dir = output_dir
+        self.root = _common_directory(self.templates)
+        self.data_path = data or None
+        self.yaml_loader = yaml_loader or 'SafeLoader'
+        self.partials_path = partials_path
+        self.partials_ext = partials_ext
+        self.def_ldel = kwargs.get('def_ldel', '{{')
+        self.def_rdel = kwargs.get('def_rdel', '}}')
+        self.render_args = kwargs
+
+        self.data = {}
+        self._data_stat = None
+        # template -> why it couldn't be rendered
+        self.errors = {}
+        self._logged = {}
+        # file -> (stat, compiled template)
+        self._compiled = {}
+        # template -> the partials it used when it was last rendered
+        self._used = {}
+        # file -> its stat when it couldn't be compiled
+        self._missing = {}
+        self._partials = _Partials(self)
+
+        # (Two templates rendered to one file would overwrite each other)
+        rendered_by = {}
+        for template in self.templates:
+            output_path = self.output_path(template)
+            if output_path in rendered_by:
+                raise ValueError('{0} and {1} would both be rendered to {2}'
+                                 .format(rendered_by[output_path], template,
+                                         output_path))
+            rendered_by[output_path] = template
+
+    def output_path(self, template):
+        """Get the file a template is rendered to"""
+        name = os.path.relpath(os.path.abspath(template), self.root)
+        return os.path.join(self.output_dir, os.path.splitext(name)[0])
+
+    def partial_path(self, name):
+        """Get the file a partial would be in"""
+        if not self.partials_path:
+            return None
+        path_ext = ('.' + self.partials_ext if self.partials_ext else '')
+        return os.path.join(self.partials_path, name + path_ext)
+
+    def get_partial(self, name):
+        """Get a compiled partial, raises KeyError if there isn't one"""
+        file_path = self.partial_path(name)
+        if file_path is None:
+            raise KeyError(name)
+        return self._get_compiled(file_path)
+
+    def _get_compiled(self, file_path):
+        try:
+            return self._compiled[file_path][1]
+        except KeyError:
+            pass
+
+        # Files that are missing or broken are remembered as they
+        # were, so we know when to try them again
+        stat = _stat(file_path)
+        self._missing[file_path] = stat
+        try:
+            template = _compile_file(file_path, self.def_ldel, self.def_rdel)
+        except IOError:
+            raise KeyError(file_path)
+        del self._missing[file_path]
+        self._compiled[file_path] = (stat, template)
+        return template
+
+    def _changed(self):
+        """Find the templates that need to be rendered again"""
+
+        # Forget every file that changed since it was compiled
+        changed_files = set()
+        for file_path, (stat, _) in list(self._compiled.items()):
+            if _stat(file_path) != stat:
+                del self._compiled[file_path]
+                changed_files.add(file_path)
+
+        # If the data changed, everything needs rendering again
+        if self.data_path is not None:
+            stat = _stat(self.data_path)
+            if stat != self._data_stat:
+                try:
+                    from .main import _load_data_file
+                except (ValueError, SystemError):  # python 2
+                    from main import _load_data_file
+
+                # (Don't try again until it changes, if it's broken)
+                self._data_stat = stat
+                self.data = _load_data_file(self.data_path, self.yaml_loader)
+                return list(self.templates)
+
+        changed = []
+        for template in self.templates:
+            if template not in self._used:
+                changed.append(template)
+                continue
+
+            # A template changed if it, or a partial it used did.
+            # (Partials that didn't exist when we looked count too,
+            # in case they've been created)
+            files = [template] + [self.partial_path(name)
+                                  for name in self._used[template]
+                                  if self.partials_path]
+            for file_path in files:
+                if file_path in changed_files or \
+                        (file_path not in self._compiled and
+                         _stat(file_path) != self._missing.get(file_path)):
+                    changed.append(template)
+                    break
+
+        return changed
+
+    def build(self):
+        """Render the templates that changed since the last build
+
+        Templates that can't be rendered are left out, and the reasons
+        why are kept in errors (until they're rendered again).
+
+        Returns the files that were written.
+        """
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        written = []
+        for template in self._changed():
+            self.errors.pop(template, None)
+            self._partials.used = set()
+            try:
+                output = render(self._get_compiled(template), self.data,
+                                partials_dict=self._partials,
+                                partials_path=None,
+                                partials_ext=self.partials_ext,
+                                **self.render_args)
+            except (SyntaxError, KeyError, IOError, RuntimeError) as error:
+                # (Runtime errors are partials that include themselves,
+                # and renders that hit their limits)
+                self.errors[template] = error
+                continue
+            finally:
+                self._used[template] = self._partials.used
+                self._partials.used = None
+
+            output_path = self.output_path(template)
+            if not os.path.isdir(os.path.dirname(output_path)):
+                os.makedirs(os.path.dirname(output_path))
+            with io.open(output_path, 'w', encoding='utf-8') as output_file:
+                output_file.write(output)
+            written.append(output_path)
+
+        return written
+
+    def watch(self, interval=0.5, log=sys.stderr):
+        """Build, then keep building whenever something changes
+
+        Errors are logged rather than raised, so a template that's
+        half way through being edited doesn't stop the watching.
+        """
+        while True:
+            try:
+                for output_path in self.build():
+                    log.write('chevron: wrote {0}\n'.format(output_path))
+                for template in self._changed_errors():
+                    log.write('chevron: {0}: {1}\n'.format(
+                        template, self.errors[template]))
+            except (SyntaxError, IOError, ValueError, RuntimeError) as error:
+                # (A data file being edited is a ValueError, json or yaml)
+                log.write('chevron: {0}\n'.format(error))
+            log.flush()
+            time.sleep(interval)
+
+    def _changed_errors(self):
+        """Get the templates with errors we haven't logged yet"""
+        errors = dict((template, str(error))
+                      for template, error in self.errors.items())
+        new = [template for template, error in errors.items()
+               if self._logged.get(template) != error]
+        self._logged = errors
+        return sorted(new)
@@ -6,6 +6,9 @@ import unittest
 import os
 import json
 import io
+import mmap
+import shutil
+import tempfile
 
 import chevron
 
@@ -57,8 +60,8 @@ def _test_case_from_path(json_path):
 
 # Create TestCase for each json file
 for spec in SPECS:
-    # Ignore optional tests
-    if spec[0] != '~':
+    # Ignore optional tests (except for the ones we do)
+    if spec[0] != '~' or spec.startswith('~inheritance.'):
         spec = spec.split('.')[0]
         globals()[spec] = _test_case_from_path(os.path.join(SPECS_PATH, spec))
 
@@ -153,6 +156,122 @@ class ExpandedCoverage(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    def test_main_data_formats(self):
+        directory = tempfile.mkdtemp()
+        try:
+            template = os.path.join(directory, 'test.mustache')
+            with io.open(template, 'w', encoding='utf-8') as f:
+                f.write(u'{{#list}}{{.}}{{/list}}')
+
+            files = {
+                'data.json': u'{"list": [1, 2]}',
+                'data': u'{"list": [1, 2]}',
+            }
+            try:
+                import yaml  # noqa: F401
+                files.update({
+                    'data.yml': u'list: [1, 2]',
+                    'data.yaml': u'list:\n  - 1\n  - 2\n',
+                    'flow': u'{list: [1, 2]}',
+                })
+            except ImportError:
+                pass
+            for name, text in files.items():
+                data = os.path.join(directory, name)
+                with io.open(data, 'w', encoding='utf-8') as f:
+                    f.write(text)
+
+                result = chevron.main(template, data)
+                self.assertEqual(result, '12')
+
+            # Loading the same data again comes from the cache
+            import importlib
+            main = importlib.import_module('chevron.main')
+            data = os.path.join(directory, 'data.json')
+            self.assertIs(main._load_data_file(data),
+                          main._load_data_file(data))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_streamed_template(self):
+        template = '{{#list}}\n  ({{.}})\n{{/list}}\n' * 3 + '☃ {{{ end }}}'
+        data = {'list': [1, 2], 'end': '<end>'}
+
+        expected = chevron.render(template, data)
+
+        for chunk_size in (1, 2, 7):
+            binary = io.BytesIO(template.encode('utf-8'))
+            tokens = chevron.tokenizer.tokenize(binary, chunk_size=chunk_size)
+            result = chevron.render(list(tokens), data)
+
+            self.assertEqual(result, expected)
+
+    def test_streamed_render(self):
+        template = u'{{#list}}({{.}}){{/list}} {{x}}\n' * 5000
+        data = {'list': [1, 2], 'x': '<x>'}
+        expected = chevron.render(template, data)
+
+        class Output(object):
+            def __init__(self):
+                self.parts = []
+                self.read_at_first_write = None
+
+            def write(self, text):
+                if self.read_at_first_write is None:
+                    self.read_at_first_write = source.tell()
+                self.parts.append(text)
+
+        # File-like templates are rendered as they're read
+        source = io.StringIO(template)
+        out = Output()
+        chevron.render(source, data, out=out)
+        self.assertEqual(''.join(out.parts), expected)
+        self.assertTrue(out.read_at_first_write < len(template) // 2)
+
+    def test_mmap_template(self):
+        with io.open('tests/test.mustache', 'rb') as f:
+            template = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                with io.open('tests/data.json', 'r', encoding='utf-8') as d:
+                    data = json.load(d)
+                result = chevron.render(template, data,
+                                        partials_path='tests')
+            finally:
+                template.close()
+
+        with io.open('tests/test.rendered', 'r', encoding='utf-8') as f:
+            expected = f.read()
+            if not python3:
+                expected = expected.encode('utf-8')
+
+        self.assertEqual(result, expected)
+
+    def test_tokens(self):
+        template = 'Hi {{# people }}{{ name.first }} {{/ people }}'
+        tokens = list(chevron.tokenizer.tokenize(template))
+
+        # Tokens still act like (tag_type, tag_key) tuples
+        self.assertEqual(tokens, [('literal', 'Hi '),
+                                  ('section', 'people'),
+                                  ('variable', 'name.first'),
+                                  ('literal', ' '),
+                                  ('end', 'people')])
+        tag_type, tag_key = tokens[2]
+        self.assertEqual((tag_type, tag_key), ('variable', 'name.first'))
+
+        self.assertEqual(tokens[2].op, chevron.tokenizer.VARIABLE)
+        self.assertEqual(tokens[2].path, ('name', 'first'))
+        section = tokens[1]
+        self.assertEqual(template[section.start:section.stop],
+                         '{{# people }}')
+
+        data = {'people': [{'name': {'first': 'Ann'}},
+                           {'name': {'first': 'Bob'}}]}
+        expected = 'Hi Ann Bob '
+        self.assertEqual(chevron.render(tokens, data), expected)
+        self.assertEqual(chevron.render([tuple(t) for t in tokens], data),
+                         expected)
+
     def test_recursion(self):
         args = {
             'template': '{{# 1.2 }}{{# data }}{{.}}{{/ data }}{{/ 1.2 }}',
@@ -164,6 +283,861 @@ class ExpandedCoverage(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    def test_loop_outer_scopes(self):
+        data = {
+            'sep': ',',
+            'rows': [{'row': 'a', 'cells': [1, 2]},
+                     {'row': 'b', 'cells': [3]}],
+        }
+        template = '{{#rows}}{{#cells}}{{row}}{{.}}{{sep}}{{/cells}}|{{/rows}}'
+
+        result = chevron.render(template, data)
+        expected = 'a1,a2,|b3,|'
+        self.assertEqual(result, expected)
+
+        # The scopes passed in are left as they were
+        scopes = [{'sep': ';'}, data]
+        result = chevron.render(template, scopes=scopes)
+        expected = 'a1;a2;|b3;|'
+        self.assertEqual(result, expected)
+        self.assertEqual(scopes, [{'sep': ';'}, data])
+
+    def test_deep_recursion(self):
+        # A tree that is deeper than python's recursion limit
+        tree = {'name': 'leaf', 'children': []}
+        expected = 'leaf'
+        for i in range(sys.getrecursionlimit() + 10):
+            tree = {'name': str(i), 'children': [tree]}
+            expected = '{0}({1})'.format(i, expected)
+
+        args = {
+            'template': '{{> node }}',
+            'data': tree,
+            'partials_dict': {
+                'node': '{{name}}{{#children}}({{> node }}){{/children}}',
+            },
+            'max_depth': None,
+        }
+
+        result = chevron.render(**args)
+        self.assertEqual(result, expected)
+
+        # RecursionError is a RuntimeError (which python 2 has)
+        args['max_depth'] = 10
+        self.assertRaises(RuntimeError, chevron.render, **args)
+
+    def test_analyze(self):
+        args = {
+            'template': 'Hi {{name}}\n{{#items}}\n  {{> row }}\n{{/items}}',
+            'partials_dict': {'row': '{{title}}{{> missing }}'},
+            'partials_path': None,
+        }
+
+        info = chevron.analyze(**args)
+
+        self.assertEqual([(ref.key, ref.line, ref.column, ref.template)
+                          for ref in info.keys],
+                         [('name', 1, 4, None),
+                          ('items', 2, 1, None),
+                          ('title', 1, 1, 'row')])
+        # (A partial's tags are in the sections it was included in)
+        self.assertEqual([(ref.key, ref.sections) for ref in info.partials],
+                         [('row', ('items',)), ('missing', ('items',))])
+        self.assertEqual(info.missing, ['missing'])
+        self.assertEqual(info.key_paths(),
+                         set(['name', 'items', 'items.title']))
+
+        # A partial included in more than one place is in all of them
+        partials = {'p': '{{x}}{{#a}}{{> p }}{{/a}}'}
+        info = chevron.analyze('{{#a}}{{> p }}{{/a}}{{> p }}{{#b}}{{> p }}'
+                               '{{/b}}', partials_dict=partials)
+        self.assertEqual(info.key_paths(),
+                         set(['a', 'a.x', 'a.a', 'x', 'b', 'b.x', 'b.a']))
+
+        args['partials_dict'] = {'row': '{{# oops }}'}
+        self.assertRaises(chevron.ChevronError, chevron.analyze, **args)
+
+        # Compiled partials are followed too (without lines and columns)
+        args['partials_dict'] = {
+            'row': chevron.compile_template('{{title}}{{> missing }}')}
+        info = chevron.analyze(**args)
+        self.assertEqual([(ref.key, ref.line) for ref in info.keys],
+                         [('name', 1), ('items', 2), ('title', None)])
+        self.assertEqual(info.missing, ['missing'])
+
+    def test_validate(self):
+        directory = tempfile.mkdtemp()
+        try:
+            good = os.path.join(directory, 'good.mustache')
+            bad = os.path.join(directory, 'bad.mustache')
+            with io.open(good, 'w', encoding='utf-8') as f:
+                f.write(u'{{# list }}{{> part }}{{/ list }}')
+            with io.open(bad, 'w', encoding='utf-8') as f:
+                f.write(u'{{# list }} oops')
+            with io.open(os.path.join(directory, 'part.mustache'), 'w',
+                         encoding='utf-8') as f:
+                f.write(u'{{ item }}')
+
+            for workers in (1, 2):
+                errors = chevron.validate([good, bad],
+                                          partials_path=directory,
+                                          workers=workers)
+                self.assertEqual(list(errors), [bad])
+                self.assertTrue('"list" was never closed' in errors[bad])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_compile_template(self):
+        template = chevron.compile_template('{{#list}}({{.}}){{/list}}')
+
+        self.assertTrue(isinstance(template, chevron.Template))
+        self.assertTrue(template is chevron.compile_template(
+            '{{#list}}({{.}}){{/list}}'))
+
+        result = chevron.render(template, {'list': [1, 2]})
+        expected = '(1)(2)'
+        self.assertEqual(result, expected)
+
+    def test_loader(self):
+        directory = tempfile.mkdtemp()
+        try:
+            files = {
+                ('theme', 'page.mustache'): u'theme {{> parts/title }}',
+                ('base', 'page.mustache'): u'base',
+                ('base', 'parts', 'title.mustache'): u'<{{ title }}>',
+                ('base', 'notes.txt'): u'not a template',
+            }
+            for names, text in files.items():
+                file_path = os.path.join(directory, *names)
+                if not os.path.isdir(os.path.dirname(file_path)):
+                    os.makedirs(os.path.dirname(file_path))
+                with io.open(file_path, 'w', encoding='utf-8') as f:
+                    f.write(text)
+
+            loader = chevron.Loader([os.path.join(directory, 'theme'),
+                                     os.path.join(directory, 'base')])
+            self.assertEqual(loader.names(), ['page', 'parts/title'])
+
+            loader.preload(workers=2)
+            shutil.rmtree(directory)
+
+            # Nothing is read from the filesystem after preloading
+            result = loader.render('page', {'title': 'hi'})
+            expected = 'theme <hi>'
+            self.assertEqual(result, expected)
+
+            result = chevron.render('{{> parts/title }}{{> nope }}',
+                                    {'title': 'hi'}, partials_dict=loader)
+            expected = '<hi>'
+            self.assertEqual(result, expected)
+        finally:
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+
+    def test_archive_loader(self):
+        import zipfile
+
+        directory = tempfile.mkdtemp()
+        archive = os.path.join(directory, 'bundle.zip')
+        try:
+            with zipfile.ZipFile(archive, 'w') as bundle:
+                bundle.writestr('theme/page.mustache', 'theme {{> title }}')
+                bundle.writestr('base/page.mustache', 'base {{> title }}')
+                bundle.writestr('base/title.mustache', '<{{ title }}>')
+                bundle.writestr('zipped/__init__.py', '')
+                bundle.writestr('zipped/templates/hi.mustache', 'hi {{x}}')
+
+            with chevron.ArchiveLoader(archive, ['theme', 'base']) as loader:
+                self.assertEqual(loader.names(), ['page', 'title'])
+                self.assertEqual(loader.get_source('title'), '<{{ title }}>')
+                loader.preload(workers=2)
+                result = loader.render('page', {'title': 'hi'})
+                self.assertEqual(result, 'theme <hi>')
+
+            # The partials of main can be in an archive too
+            template = os.path.join(directory, 'main.mustache')
+            with io.open(template, 'w', encoding='utf-8') as f:
+                f.write(u'{{> base/title }}')
+            result = chevron.main(template, partials_path=archive)
+            self.assertEqual(result, '<>')
+
+            # And so can a package's templates
+            sys.path.insert(0, archive)
+            try:
+                loader = chevron.Loader.from_package('zipped')
+                self.assertIsInstance(loader, chevron.ArchiveLoader)
+                self.assertEqual(loader.render('hi', {'x': 1}), 'hi 1')
+                loader.close()
+            finally:
+                sys.path.remove(archive)
+                sys.modules.pop('zipped', None)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_watch(self):
+        from chevron.watch import Watcher
+
+        directory = tempfile.mkdtemp()
+
+        def write(name, text):
+            file_path = os.path.join(directory, name)
+            with io.open(file_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            # Make sure the change shows, however coarse the mtime is
+            stat = os.stat(file_path)
+            os.utime(file_path, (stat.st_atime, stat.st_mtime + 10))
+            return file_path
+
+        try:
+            templates = [write('a.html.mustache', u'a {{>head}}'),
+                         write('b.mustache', u'b {{#x}}{{>new}}{{/x}}')]
+            write('head.mustache', u'<{{ title }}>')
+            data = write('data.json', u'{"title": "hi"}')
+
+            output_dir = os.path.join(directory, 'out')
+            watcher = Watcher(templates, output_dir, data=data,
+                              partials_path=directory)
+
+            def outputs(written):
+                return sorted(os.path.basename(f) for f in written)
+
+            self.assertEqual(outputs(watcher.build()), ['a.html', 'b'])
+            self.assertEqual(outputs(watcher.build()), [])
+            with io.open(os.path.join(output_dir, 'a.html')) as f:
+                self.assertEqual(f.read(), 'a <hi>')
+
+            # Only what used the partial is rendered again
+            write('head.mustache', u'[{{ title }}]')
+            self.assertEqual(outputs(watcher.build()), ['a.html'])
+
+            # A broken template is reported, and tried again once it changes
+            write('b.mustache', u'b {{#x}}')
+            self.assertEqual(outputs(watcher.build()), [])
+            self.assertEqual(list(watcher.errors), [templates[1]])
+            self.assertEqual(outputs(watcher.build()), [])
+            write('b.mustache', u'b {{#x}}{{>new}}{{/x}}')
+
+            # Data changes render everything, new partials what used them
+            write('data.json', u'{"title": "hi", "x": true}')
+            self.assertEqual(outputs(watcher.build()), ['a.html', 'b'])
+            self.assertEqual(watcher.errors, {})
+            write('new.mustache', u'new')
+            self.assertEqual(outputs(watcher.build()), ['b'])
+            with io.open(os.path.join(output_dir, 'b')) as f:
+                self.assertEqual(f.read(), 'b new')
+
+            # Pages of the same name in different directories keep them
+            for language in ('en', 'fr'):
+                os.mkdir(os.path.join(directory, language))
+            pages = [write(os.path.join('en', 'index.mustache'), u'en'),
+                     write(os.path.join('fr', 'index.mustache'), u'fr')]
+            watcher = Watcher(pages, output_dir)
+            self.assertEqual(outputs(watcher.build()), ['index', 'index'])
+            for language in ('en', 'fr'):
+                with io.open(os.path.join(output_dir, language,
+                                          'index')) as f:
+                    self.assertEqual(f.read(), language)
+
+            # (and two templates can't be rendered to the same file)
+            self.assertRaises(ValueError, Watcher,
+                              [write('a.html.txt', u'a')] + templates[:1],
+                              output_dir)
+
+            # A partial that includes itself is only an error
+            loop = write('loop.mustache', u'{{>loop}}')
+            watcher = Watcher([loop], output_dir, partials_path=directory)
+            self.assertEqual(outputs(watcher.build()), [])
+            self.assertIsInstance(watcher.errors[loop], RuntimeError)
+
+            # And so is a data file half way through being edited
+            import chevron.watch
+            data = write('data.yml', u'title: [hi')
+            watcher = Watcher(templates[:1], output_dir, data=data,
+                              partials_path=directory)
+            log = io.StringIO() if python3 else io.BytesIO()
+
+            def stop(interval):
+                raise KeyboardInterrupt()
+
+            sleep = chevron.watch.time.sleep
+            chevron.watch.time.sleep = stop
+            try:
+                self.assertRaises(KeyboardInterrupt, watcher.watch, 0, log)
+            finally:
+                chevron.watch.time.sleep = sleep
+            self.assertIn('chevron: ', log.getvalue())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_server(self):
+        from chevron.server import Server
+
+        directory = tempfile.mkdtemp()
+        try:
+            files = {
+                'page.mustache': u'<{{> title }}>',
+                'title.mustache': u'{{ title }}',
+                'data.json': u'{"title": "hi"}',
+                'loop.mustache': u'{{> loop }}',
+                'broken.yml': u'title: [hi',
+            }
+            for name, text in files.items():
+                with io.open(os.path.join(directory, name), 'w',
+                             encoding='utf-8') as f:
+                    f.write(text)
+
+            requests = [
+                {'template': os.path.join(directory, 'page.mustache'),
+                 'data': os.path.join(directory, 'data.json'),
+                 'partials_path': directory},
+                {'template': os.path.join(directory, 'nope.mustache')},
+                {'template': os.path.join(directory, 'page.mustache'),
+                 'colour': 'blue'},
+                {'template': os.path.join(directory, 'loop.mustache'),
+                 'partials_path': directory},
+                {'template': os.path.join(directory, 'page.mustache'),
+                 'data': os.path.join(directory, 'broken.yml')},
+            ]
+            lines = [json.dumps(request) for request in requests]
+            lines.append('not json')
+
+            chevron.reset_metrics()
+            responses = []
+            Server().handle_lines(lines, responses.append)
+            responses = [json.loads(response) for response in responses]
+
+            self.assertEqual(responses[0], {'output': '<hi>'})
+            # (Compiling the templates is counted in the metrics)
+            self.assertGreater(chevron.metrics()['tokens'], 0)
+            self.assertEqual([list(response) for response in responses[1:]],
+                             [['error']] * 5)
+            self.assertIn('depth', responses[3]['error'])
+            self.assertIn('yaml', responses[4]['error'])
+
+            # A server that isn't there is an error, not a traceback
+            argv = sys.argv
+            sys.argv = ['chevron', '--connect',
+                        os.path.join(directory, 'nope.sock'),
+                        os.path.join(directory, 'page.mustache')]
+            try:
+                with self.assertRaises(SystemExit) as context:
+                    chevron.cli_main()
+            finally:
+                sys.argv = argv
+            self.assertIn('Chevron: could not reach the server',
+                          str(context.exception.code))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_incremental(self):
+        template = ('{{#stats}}{{count}} of {{total}}{{/stats}}\n'
+                    '{{#list}}<{{.}}>{{/list}}\n'
+                    '  {{> part }}\n'
+                    'Hi {{ name }}')
+        partials = {'part': '[{{ name }}]\n'}
+        data = {'stats': {'count': 1, 'total': 2}, 'list': [1, 2],
+                'name': 'a'}
+
+        page = chevron.Incremental(template, data, partials_dict=partials)
+        expected = chevron.render(template, data, partials_dict=partials)
+        self.assertEqual(page.text, expected)
+
+        # Only what reads the keys that changed is rendered again
+        data = dict(data, name='b')
+        result = page.update(data)
+        expected = chevron.render(template, data, partials_dict=partials)
+        self.assertEqual(result, expected)
+        self.assertEqual(page.rendered, 2)
+
+        # Changes made in place are named
+        data['stats']['count'] = 2
+        result = page.update(data, changed=['stats.count'])
+        expected = chevron.render(template, data, partials_dict=partials)
+        self.assertEqual(result, expected)
+        self.assertEqual(page.rendered, 1)
+
+        self.assertEqual(page.update(data, changed=[]), expected)
+        self.assertEqual(page.rendered, 0)
+
+    def test_parallel_list(self):
+        args = {
+            'template': ('{{#list}}\n  {{> row }}\n{{/list}}'
+                         '{{#big}}{{.}}{{/big}}'),
+            'partials_dict': {'row': '{{ name }}{{#tags}} {{.}}{{/tags}}\n'},
+            'data': {'list': [{'name': 'a', 'tags': [1, 2]}, {}, None,
+                              {'name': 'b', 'tags': []}] * 10,
+                     'big': list(range(100)),
+                     'name': 'outer'},
+        }
+        expected = chevron.render(**args)
+
+        result = chevron.render(workers=2, parallel_threshold=5, **args)
+        self.assertEqual(result, expected)
+
+    def test_render_limits(self):
+        args = {
+            'template': '{{#list}}{{.}},{{/list}}',
+            'data': {'list': list(range(1000))},
+        }
+
+        limits = [('max_output_bytes', 100), ('max_iterations', 50),
+                  ('deadline', -1)]
+        for limit, value in limits:
+            kwargs = dict(args)
+            kwargs[limit] = value
+            with self.assertRaises(chevron.RenderLimitError) as context:
+                chevron.render(**kwargs)
+            self.assertEqual(context.exception.limit, limit)
+            self.assertLess(context.exception.stats['iterations'], 1000)
+
+            # (The output so far is counted, whichever limit it was)
+            output = context.exception.stats['output']
+            if limit == 'deadline':
+                self.assertEqual(output, 0)
+            else:
+                self.assertGreater(output, 0)
+
+        # What was already written to out counts too
+        class Output(object):
+            def write(self, text):
+                pass
+
+        with self.assertRaises(chevron.RenderLimitError) as context:
+            chevron.render(out=Output(), max_iterations=900, **args)
+        # (0 is falsy, so it isn't rendered)
+        self.assertEqual(context.exception.stats['output'],
+                         len(''.join('{0},'.format(i) for i in range(1, 900))))
+
+        # The output is counted in bytes, not characters
+        with self.assertRaises(chevron.RenderLimitError) as context:
+            chevron.render('{{#list}}é{{/list}}', {'list': [1] * 60},
+                           max_output_bytes=100)
+        self.assertEqual(context.exception.limit, 'max_output_bytes')
+        self.assertGreater(context.exception.stats['output'], 100)
+
+        # A partial that includes itself is stopped too
+        with self.assertRaises(chevron.RenderLimitError):
+            chevron.render('{{> self }}',
+                           partials_dict={'self': 'x{{> self }}'},
+                           max_iterations=100)
+
+        # And renders within the limits aren't
+        result = chevron.render(max_output_bytes=10000, max_iterations=2000,
+                                deadline=60, **args)
+        expected = chevron.render(**args)
+        self.assertEqual(result, expected)
+
+    def test_outer_scope_memo(self):
+        class Item(object):
+            currency = 'item currency'
+
+        args = {
+            'template': ('{{#items}}{{^hide}}{{currency}}{{/hide}} '
+                         '{{site.name}},{{/items}}'),
+            'data': {'currency': 'EUR', 'site': {'name': 'shop'},
+                     'items': [{'n': 1}, {'currency': 'USD'}, {'n': 3}, Item(),
+                               {'site': {}}, {'site': {'name': 'mine'}}]},
+        }
+
+        result = chevron.render(**args)
+        expected = ('EUR shop,USD shop,EUR shop,item currency shop,'
+                    'EUR shop,EUR mine,')
+
+        self.assertEqual(result, expected)
+
+    def test_object_data(self):
+        class Slotted(object):
+            __slots__ = ('name', 'tags')
+
+            def __init__(self, name, tags):
+                self.name = name
+                self.tags = tags
+
+        class Lookup(tuple):
+            # Subscripting by key works here, so it has to stay first
+            def __getitem__(self, key):
+                return 'item ' + key if key == 'name' else 'nope'
+
+        Pair = collections.namedtuple('Pair', ['name', 'tags'])
+
+        args = {
+            'template': ('{{#rows}}{{name}}:{{tags.0}}{{tags.1}}'
+                         '{{tags.name}},{{/rows}}'),
+            'data': {'rows': [Slotted('a', ['x', 'y']), Pair('b', ('z',)),
+                              Slotted('c', Pair('p', 'q')), Lookup('l')] * 2},
+        }
+
+        result = chevron.render(**args)
+        expected = 'a:xy,b:z,c:pqp,item name:no,' * 2
+
+        self.assertEqual(result, expected)
+
+    def test_columns(self):
+        import array
+
+        people = chevron.Columns({
+            'name': ['a', 'b', '<c>'],
+            'age': array.array('i', [1, 2, 3]),
+            'height': (1.5, 1.75, 2),
+        }, formats={'height': '.2f', 'name': str.upper})
+
+        args = {
+            'template': ('{{#people}}{{name}} {{age}} {{height}}'
+                         '{{#more}} {{more}}{{/more}},{{/people}}'),
+            'data': {'people': people, 'more': '!'},
+        }
+
+        result = chevron.render(**args)
+        expected = 'A 1 1.50 !,B 2 1.75 !,&lt;C&gt; 3 2.00 !,'
+
+        self.assertEqual(result, expected)
+        self.assertEqual(len(people), 3)
+        self.assertEqual(people[-1]['age'], 3)
+
+        with self.assertRaises(ValueError):
+            chevron.Columns({'a': [1, 2], 'b': [1]})
+
+    def test_minify(self):
+        args = {
+            'template': ('<ul>\n    {{#list}}\n    <li>  {{.}}  </li>\n'
+                         '    {{/list}}\n\n  <pre>  a\n  b  </pre>\n'
+                         '  {{> part }}\n</ul>\n'),
+            'partials_dict': {'part': '<b>\n  x  </b>\n'},
+            'data': {'list': ['a  b', 'c']},
+            'minify': 'html',
+        }
+
+        result = chevron.render(**args)
+        expected = ('<ul>\n<li> a  b </li>\n<li> c </li>\n'
+                    '<pre>  a\n  b  </pre>\n<b>\nx </b>\n</ul>\n')
+
+        self.assertEqual(result, expected)
+
+        args = {
+            'template': ('{\n  "name": "{{ name }}  !",\n  "list": [\n'
+                         '    {{#list}}{{.}}, {{/list}}0\n  ],\n'
+                         '  "q": "\\" {"\n}\n'),
+            'data': {'name': 'a  b', 'list': [1, 2]},
+            'minify': 'json',
+        }
+
+        result = chevron.render(**args)
+        expected = '{"name":"a  b  !","list":[1,2,0],"q":"\\" {"}'
+
+        self.assertEqual(result, expected)
+
+    def test_compressed_output(self):
+        import gzip
+        import io
+
+        args = {
+            'template': '{{#list}}\n  {{> part }}\n{{/list}}',
+            'partials_dict': {'part': 'a\n{{.}}  \n'},
+            'data': {'list': list(range(1, 3001))},
+        }
+
+        file = io.BytesIO()
+        with chevron.CompressedWriter(file, chunk_size=100) as out:
+            self.assertEqual(chevron.render(out=out, **args), None)
+
+        file.seek(0)
+        result = gzip.GzipFile(fileobj=file).read().decode('utf-8')
+        expected = ''.join('  a\n  {0}  \n'.format(i) for i in range(1, 3001))
+
+        self.assertEqual(result, expected)
+
+    def test_fragment_cache(self):
+        import shutil
+        import tempfile
+
+        renders = []
+
+        def name(text, render):
+            renders.append(text)
+            return render(text)
+
+        template = ('{{#items}}{{#tile}}[{{#name}}{{n}}{{/name}}]'
+                    '{{/tile}}{{/items}}')
+        directory = tempfile.mkdtemp()
+        try:
+            for backend in (chevron.MemoryCache(max_bytes=100),
+                            chevron.DirectoryCache(directory)):
+                cache = chevron.FragmentCache(backend)
+                del renders[:]
+
+                for n in ('é', 'é', 'b'):
+                    data = {
+                        'items': [{'id': 1, 'n': n}, {'id': 2, 'n': 'c'}],
+                        'tile': cache.section('{{id}}-{{n}}'),
+                        'name': name,
+                    }
+                    result = chevron.render(template, data)
+                    self.assertEqual(result, '[{0}][c]'.format(n))
+
+                self.assertEqual((cache.hits, cache.misses), (3, 3))
+                self.assertEqual(len(renders), 3)
+        finally:
+            shutil.rmtree(directory)
+
+        cache = chevron.MemoryCache(max_bytes=10, ttl=0)
+        cache.set('a', 'x' * 6)
+        cache.set('b', 'y' * 6)
+        self.assertEqual((cache.get('a'), cache.get('b')), (None, None))
+        self.assertEqual(cache.size, 0)
+
+        # Its size is in bytes, not characters
+        cache = chevron.MemoryCache(max_bytes=10)
+        cache.set('a', 'é' * 4)
+        cache.set('b', 'é' * 2)
+        self.assertEqual((cache.get('a'), cache.get('b')), (None, 'éé'))
+        self.assertEqual(cache.size, 4)
+
+    def test_inheritance(self):
+        partials = {
+            'layout': ('<title>{{$title}}Untitled{{/title}}</title>\n'
+                       '<main>\n'
+                       '  {{$body}}{{/body}}\n'
+                       '</main>\n'),
+            'page': ('{{<layout}}\n'
+                     '{{$title}}{{name}}{{/title}}\n'
+                     '{{/layout}}\n'),
+        }
+        args = {
+            'template': ('{{<page}}\n'
+                         '  {{$body}}\n'
+                         '    <p>{{name}}</p>\n'
+                         '    {{#list}}\n'
+                         '    <i>{{.}}</i>\n'
+                         '    {{/list}}\n'
+                         '  {{/body}}\n'
+                         '{{/page}}\n'),
+            'partials_dict': partials,
+            'data': {'name': 'Hi', 'list': [1, 2]},
+        }
+
+        result = chevron.render(**args)
+        expected = ('<title>Hi</title>\n'
+                    '<main>\n'
+                    '  <p>Hi</p>\n'
+                    '  <i>1</i>\n'
+                    '  <i>2</i>\n'
+                    '</main>\n')
+
+        self.assertEqual(result, expected)
+
+        # The outermost child's blocks win, and the rest are defaults
+        result = chevron.render('{{<page}}{{$title}}Mine{{/title}}{{/page}}',
+                                partials_dict=partials)
+        expected = '<title>Mine</title>\n<main>\n</main>\n'
+
+        self.assertEqual(result, expected)
+
+        # A loader expands the parents as it compiles
+        directory = tempfile.mkdtemp()
+        try:
+            for name, text in partials.items():
+                with open(os.path.join(directory, name + '.mustache'),
+                          'w') as template:
+                    template.write(text)
+            loader = chevron.Loader(directory)
+
+            self.assertEqual(loader.render('page', {'name': 'Hi'}),
+                             '<title>Hi</title>\n<main>\n</main>\n')
+            self.assertFalse(loader['page'].inherits)
+        finally:
+            shutil.rmtree(directory)
+
+        partials = {'loop': '{{<loop}}{{/loop}}'}
+        self.assertRaises(chevron.ChevronError, chevron.render,
+                          '{{>loop}}', partials_dict=partials)
+
+    def test_threads(self):
+        import threading
+
+        partials = {
+            'layout': '<main>\n  {{$body}}{{/body}}\n</main>\n',
+            'row': '{{#upper}}{{name}}{{/upper}}: {{n}}\n',
+        }
+        cases = []
+        for i in range(20):
+            template = ('{{<layout}}{{$body}}\n' + '\n' * i +
+                        '{{#rows}}\n{{>row}}\n{{/rows}}\n'
+                        '{{/body}}{{/layout}}')
+            data = {
+                'rows': [{'name': 'r{0}-{1}'.format(i, n), 'n': n}
+                         for n in range(i)],
+                'upper': lambda text, render: render(text).upper(),
+            }
+            cases.append((template, data,
+                          chevron.render(template, data,
+                                         partials_dict=partials)))
+
+        # (And errors name their own template's line)
+        cases.append(('\n' * 30 + '{{#open}}', {},
+                      'Unexpected EOF\nthe tag "open" was never closed\n'
+                      'was opened at line 31'))
+
+        failures = []
+
+        def work(offset):
+            try:
+                for n in range(100):
+                    template, data, expected = \
+                        cases[(offset + n) % len(cases)]
+                    try:
+                        result = chevron.render(template, data,
+                                                partials_dict=partials)
+                    except chevron.ChevronError as error:
+                        result = error.msg
+                    if result != expected:
+                        failures.append((template, result, expected))
+            except Exception as error:
+                failures.append(error)
+
+        threads = [threading.Thread(target=work, args=(offset,))
+                   for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(failures, [])
+
+    def test_flat_templates(self):
+        Point = collections.namedtuple('Point', 'x y')
+        data = {
+            'text': '<b>', 'zero': 0, 'no': False, 'none': None,
+            'float': 1.5, 'point': Point(1, 2), 'nested': {'key': 'v'},
+        }
+        template = ('{{text}} {{{text}}} {{&text}} {{zero}} {{no}} '
+                    '{{none}} {{float}} {{point.y}} {{nested.key}} '
+                    '{{missing}}{{=<% %>=}} <%text%>\n')
+
+        program = chevron.compile_template(template)
+        self.assertIsNotNone(program.flat)
+        self.assertIsNone(chevron.compile_template('{{#a}}{{/a}}').flat)
+        self.assertIsNone(chevron.compile_template('{{.}}').flat)
+        # (A literal that's only a full stop is still just text)
+        sentence = chevron.compile_template('{{a}}.{{b}}.')
+        self.assertIsNotNone(sentence.flat)
+        self.assertEqual(chevron.render(sentence, {'a': 1, 'b': 2}), '1.2.')
+
+        # It renders just like the templates that aren't flat
+        expected = chevron.render(template, scopes=[data])
+        self.assertEqual(chevron.render(template, data), expected)
+        self.assertEqual(chevron.render(template, Point('a', 'b')),
+                         chevron.render(template, scopes=[Point('a', 'b')]))
+        self.assertEqual(chevron.render('{{missing}}', {}, keep=True),
+                         '{{ missing }}')
+
+    def test_shared_strings(self):
+        boilerplate = '<html><head><title>{{page.title}}</title></head>'
+        first = chevron.compile_template(boilerplate + '<body>one')
+        second = chevron.compile_template(boilerplate + '<body>two')
+
+        # The literals and keys the templates have in common are shared
+        self.assertIs(first[0].key, second[0].key)
+        self.assertIs(first[1].key, second[1].key)
+        self.assertIs(first[1].path, second[1].path)
+        self.assertEqual(chevron.render(second, {'page': {'title': 'hi'}}),
+                         '<html><head><title>hi</title></head><body>two')
+
+        alone = chevron.footprint([first])
+        both = chevron.footprint([first, second])
+        self.assertEqual(both['templates'], 2)
+        self.assertEqual(both['tokens'], 6)
+        self.assertTrue(both['shared_bytes'] > 0)
+        self.assertTrue(both['string_bytes'] < 2 * alone['string_bytes'])
+
+        # Templates compiled by other processes are shared too
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('a', 'b', 'c'):
+                with io.open(os.path.join(directory, name + '.mustache'), 'w',
+                             encoding='utf-8') as f:
+                    f.write(u'hello {{name}} bye')
+
+            loader = chevron.Loader(directory)
+            loader.preload(workers=2, processes=True)
+            self.assertEqual(loader.footprint()['strings'], 3)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_metrics(self):
+        chevron.reset_metrics()
+        template = '{{#list}}{{>item}}{{/list}}{{#wrap}}{{nope}}{{/wrap}}'
+        data = {'list': [1, 2], 'wrap': lambda text, render: render(text)}
+        partials = {'item': '<{{.}}>'}
+        for _ in range(3):
+            chevron.render(template, data, partials_dict=partials)
+
+        metrics = chevron.metrics(reset=True)
+        # (The lambda's render counts too)
+        self.assertEqual(metrics['renders'], 6)
+        self.assertEqual(metrics['render_seconds']['count'], 6)
+        self.assertEqual(metrics['render_seconds']['buckets'][-1][1], 6)
+        self.assertEqual(metrics['template_cache']['misses'], 2)
+        self.assertEqual(metrics['partial_cache']['misses'], 1)
+        self.assertEqual(metrics['partial_cache']['hits'], 5)
+        self.assertEqual(metrics['lambda_calls'], 3)
+        self.assertEqual(metrics['missing_keys'], 3)
+        self.assertEqual(metrics['output_bytes'], 3 * len('<1><2>'))
+        self.assertTrue(metrics['tokens'] > 0)
+
+        self.assertEqual(chevron.metrics()['renders'], 0)
+
+        # (The output of a lambda's render is only counted once, and
+        # so are keys that weren't found)
+        chevron.render('{{#f}}{{x}}{{/f}}', {'x': 'a', 'f': data['wrap']})
+        chevron.Incremental('{{#nope}}x{{/nope}}', {})
+        metrics = chevron.metrics(reset=True)
+        self.assertEqual(metrics['output_bytes'], 1)
+        self.assertEqual(metrics['missing_keys'], 1)
+
+        directory = tempfile.mkdtemp()
+        try:
+            chevron.render('{{x}}', {'x': 1})
+            file_path = os.path.join(directory, 'chevron.prom')
+            chevron.write_metrics(file_path)
+            with open(file_path) as prom:
+                lines = prom.read().splitlines()
+            self.assertIn('chevron_renders_total 1', lines)
+            self.assertIn('chevron_render_seconds_bucket{le="+Inf"} 1',
+                          lines)
+            self.assertEqual(os.listdir(directory), ['chevron.prom'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_render_prefix(self):
+        seen = []
+
+        def rows():
+            for i in range(1000):
+                seen.append(i)
+                yield {'i': i}
+
+        template = '<ul>\n  {{#rows}}\n  <li>{{i}}</li>\n  {{/rows}}\n</ul>'
+        full = chevron.render(template, {'rows': list(rows())})
+        del seen[:]
+        text, truncated = chevron.render_prefix(template, {'rows': rows()},
+                                                limit=40)
+
+        self.assertEqual(text, full[:40])
+        self.assertTrue(truncated)
+        # (The render stopped once it had enough)
+        self.assertTrue(len(seen) < 10)
+
+        self.assertEqual(chevron.render_prefix('Hi {{x}}', {'x': 'you'}),
+                         ('Hi you', False))
+
+        # Templates are only read (and tokenized) as far as they're needed
+        source = io.StringIO(template * 20000)
+        text, truncated = chevron.render_prefix(source, {'rows': rows()},
+                                                limit=40)
+        self.assertEqual(text, full[:40])
+        self.assertTrue(truncated)
+        self.assertLess(source.tell(), len(template) * 10000)
+
     def test_unicode_inside_list(self):
         args = {
             'template': '{{#list}}{{.}}{{/list}}',